@@ -39,6 +39,72 @@ class Settings:
     reminder_check_interval_sec: int = field(
         default_factory=lambda: int(os.getenv("REMINDER_CHECK_INTERVAL_SEC", "300"))
     )
+    reminder_tick_sec: int = field(
+        default_factory=lambda: int(os.getenv("REMINDER_TICK_SEC", "20"))
+    )
+    reminder_horizon_hours: int = field(
+        default_factory=lambda: int(os.getenv("REMINDER_HORIZON_HOURS", "6"))
+    )
+    reminder_refill_interval_sec: int = field(
+        default_factory=lambda: int(os.getenv("REMINDER_REFILL_INTERVAL_SEC", "1800"))
+    )
+    reminder_catchup_policy: str = field(
+        default_factory=lambda: os.getenv("REMINDER_CATCHUP_POLICY", "once")
+    )
+    reminder_catchup_window_min: int = field(
+        default_factory=lambda: int(os.getenv("REMINDER_CATCHUP_WINDOW_MIN", "60"))
+    )
+    reminder_lease_sec: int = field(
+        default_factory=lambda: int(os.getenv("REMINDER_LEASE_SEC", "120"))
+    )
+    send_rate_per_sec: float = field(
+        default_factory=lambda: float(os.getenv("SEND_RATE_PER_SEC", "25"))
+    )
+    send_processes: int = field(
+        default_factory=lambda: int(os.getenv("SEND_PROCESSES", "1"))
+    )
+    send_chat_interval_sec: float = field(
+        default_factory=lambda: float(os.getenv("SEND_CHAT_INTERVAL_SEC", "1"))
+    )
+    geo_radius_m: float = field(
+        default_factory=lambda: float(os.getenv("GEO_RADIUS_M", "150"))
+    )
+    geo_cooldown_min: int = field(
+        default_factory=lambda: int(os.getenv("GEO_COOLDOWN_MIN", "360"))
+    )
+    log_retention_days: int = field(
+        default_factory=lambda: int(os.getenv("LOG_RETENTION_DAYS", "365"))
+    )
+    log_flush_interval_ms: int = field(
+        default_factory=lambda: int(os.getenv("LOG_FLUSH_INTERVAL_MS", "200"))
+    )
+    log_flush_max_rows: int = field(
+        default_factory=lambda: int(os.getenv("LOG_FLUSH_MAX_ROWS", "500"))
+    )
+    tracker_flush_interval_ms: int = field(
+        default_factory=lambda: int(os.getenv("TRACKER_FLUSH_INTERVAL_MS", "1000"))
+    )
+    tracker_buffer_size: int = field(
+        default_factory=lambda: int(os.getenv("TRACKER_BUFFER_SIZE", "5000"))
+    )
+    user_cache_ttl_sec: int = field(
+        default_factory=lambda: int(os.getenv("USER_CACHE_TTL_SEC", "120"))
+    )
+    answer_window_hours: int = field(
+        default_factory=lambda: int(os.getenv("ANSWER_WINDOW_HOURS", "12"))
+    )
+    achievement_batch_hour: int = field(
+        default_factory=lambda: int(os.getenv("ACHIEVEMENT_BATCH_HOUR", "3"))
+    )
+    stock_reconcile_sec: int = field(
+        default_factory=lambda: int(os.getenv("STOCK_RECONCILE_SEC", "21600"))
+    )
+    forecast_batch_hour: int = field(
+        default_factory=lambda: int(os.getenv("FORECAST_BATCH_HOUR", "2"))
+    )
+    low_stock_days: int = field(
+        default_factory=lambda: int(os.getenv("LOW_STOCK_DAYS", "5"))
+    )
     low_stock_threshold: int = field(
         default_factory=lambda: int(os.getenv("LOW_STOCK_THRESHOLD", "3"))
     )
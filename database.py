@@ -1,8 +1,17 @@
-from sqlalchemy import create_engine
+import logging
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, List, Optional
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
 from config import settings
 
+logger = logging.getLogger(__name__)
+
 connect_args = {}
 if settings.database_url.startswith("sqlite"):
     connect_args["check_same_thread"] = False
@@ -10,11 +19,66 @@ if settings.database_url.startswith("sqlite"):
 engine = create_engine(settings.database_url, connect_args=connect_args, future=True)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgres": "postgresql+asyncpg",
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+}
+
+
+def async_database_url(url: str) -> str:
+    scheme, sep, rest = url.partition("://")
+    return f"{ASYNC_DRIVERS.get(scheme, scheme)}{sep}{rest}"
+
+
+# Handlers and the web server run service functions on this engine through
+# ``AsyncSession.run_sync`` so database I/O is awaited instead of blocking the
+# event loop. Objects stay loaded after commit because they are read once the
+# session call has returned.
+async_engine = create_async_engine(async_database_url(settings.database_url))
+AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+_statements: ContextVar[Optional[List[int]]] = ContextVar("statements", default=None)
+
+
+@event.listens_for(async_engine.sync_engine, "before_cursor_execute")
+def _count_statement(conn, cursor, statement, parameters, context, executemany) -> None:
+    counter = _statements.get()
+    if counter is not None:
+        counter[0] += 1
+
+
+@asynccontextmanager
+async def unit_of_work() -> AsyncIterator[AsyncSession]:
+    """One session and one transaction for a bot update or web request.
+
+    Services only flush; the transaction is committed once when the block
+    exits and rolled back if it raises. The number of statements sent is
+    logged at debug level.
+    """
+    counter = [0]
+    token = _statements.set(counter)
+    started = time.monotonic()
+    try:
+        async with AsyncSessionLocal() as session:
+            async with session.begin():
+                yield session
+    finally:
+        _statements.reset(token)
+        logger.debug(
+            "Unit of work: %d statements in %.1f ms",
+            counter[0],
+            (time.monotonic() - started) * 1000,
+        )
+
 
 def init_db() -> None:
+    from migrations import run_migrations
     from models import Base
 
     Base.metadata.create_all(bind=engine)
+    run_migrations(engine)
 
 
 def get_db():
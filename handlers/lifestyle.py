@@ -1,8 +1,14 @@
 from telegram import Update
 from telegram.ext import ContextTypes
 
-from database import get_db
+from database import unit_of_work
 from services import lifestyle_service, user_service
+from services.lifestyle_service import TrackerEntry
+
+
+async def flush_entries(entries: list[TrackerEntry]) -> None:
+    async with unit_of_work() as db:
+        await db.run_sync(lifestyle_service.insert_entries, entries)
 
 
 async def symptom_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -18,13 +24,11 @@ async def symptom_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         if digits.isdigit():
             severity = max(1, min(10, int(digits)))
 
-    db = next(get_db())
-    try:
-        user = user_service.ensure_user(db, update.effective_user)
-        lifestyle_service.log_symptom(db, user, description, severity)
-        insight = lifestyle_service.symptom_insight(db, user)
-    finally:
-        db.close()
+    async with unit_of_work() as db:
+        user = await db.run_sync(user_service.ensure_user, update.effective_user)
+        entry = lifestyle_service.symptom_entry(user, description, severity)
+        insight = await db.run_sync(lifestyle_service.symptom_insight, user, [entry.values["logged_at"]])
+    await context.application.bot_data["tracker_buffer"].put(entry)
 
     response = f"Записал симптом «{description}», интенсивность {severity}/10."
     if insight:
@@ -43,12 +47,11 @@ async def mood_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         return
     note = " ".join(context.args[1:]) if len(context.args) > 1 else None
 
-    db = next(get_db())
-    try:
-        user = user_service.ensure_user(db, update.effective_user)
-        lifestyle_service.log_mood(db, user, max(1, min(10, score)), note)
-    finally:
-        db.close()
+    async with unit_of_work() as db:
+        user = await db.run_sync(user_service.ensure_user, update.effective_user)
+    await context.application.bot_data["tracker_buffer"].put(
+        lifestyle_service.mood_entry(user, max(1, min(10, score)), note)
+    )
     await update.message.reply_text("Настроение сохранено.")
 
 
@@ -59,10 +62,7 @@ async def water_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
             amount = int(context.args[0])
         except ValueError:
             pass
-    db = next(get_db())
-    try:
-        user = user_service.ensure_user(db, update.effective_user)
-        lifestyle_service.log_water(db, user, amount)
-    finally:
-        db.close()
+    async with unit_of_work() as db:
+        user = await db.run_sync(user_service.ensure_user, update.effective_user)
+    await context.application.bot_data["tracker_buffer"].put(lifestyle_service.water_entry(user, amount))
     await update.message.reply_text(f"Отлично! +{amount} мл к дневному балансу.")
@@ -13,12 +13,44 @@ from telegram import (
 from telegram.ext import ContextTypes, ConversationHandler
 
 from config import settings
-from database import get_db
+from database import unit_of_work
 from models import Medication
-from services import medication_service, knowledge_service, user_service
+from services import medication_service, knowledge_service, stock_forecast, user_service
+from services.send_queue import Priority, SendQueue
 from handlers.states import StockEditState
 
 STOCK_EDIT_KEY = "pending_stock_edit"
+PHARMACY_SEARCH_URL = "https://www.google.com/maps/search/%D0%B0%D0%BF%D1%82%D0%B5%D0%BA%D0%B0/"
+
+
+def _days_left_text(med: Medication) -> Optional[str]:
+    days_left = stock_forecast.days_left(med)
+    if days_left is None:
+        return None
+    if days_left == 0:
+        return "закончится сегодня"
+    return f"хватит на {days_left} дн. (до {med.runs_out_on:%d.%m})"
+
+
+def submit_low_stock_alert(send_queue: SendQueue, chat_id: int, med: Medication) -> None:
+    left = _days_left_text(med)
+    text = f"Заканчивается {med.name}. Осталось всего {med.stock_remaining:g}"
+    text += f", {left}.\nЧто делаем?" if left else ".\nЧто делаем?"
+    keyboard = InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton("Найти аптеки", url=PHARMACY_SEARCH_URL),
+                InlineKeyboardButton("Изменить остаток", callback_data=f"med_stock:{med.id}"),
+            ]
+        ]
+    )
+    send_queue.submit(
+        chat_id,
+        text,
+        priority=Priority.STOCK,
+        collapse_key=f"stock:{med.id}",
+        reply_markup=keyboard,
+    )
 
 
 def _med_inline_keyboard(med: Medication) -> InlineKeyboardMarkup:
@@ -55,15 +87,14 @@ async def add_med_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 async def handle_webapp_payload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     payload = json.loads(update.message.web_app_data.data)
-    db = next(get_db())
-    try:
-        user = user_service.ensure_user(db, update.effective_user)
-        medication = medication_service.create_medication(db, user, payload)
+    async with unit_of_work() as db:
+        user = await db.run_sync(user_service.ensure_user, update.effective_user)
+        medication = await db.run_sync(medication_service.create_medication, user, payload)
         existing_names = [
-            med.name for med in medication_service.list_medications(db, user) if med.id != medication.id
+            med.name
+            for med in await db.run_sync(medication_service.list_medications, user)
+            if med.id != medication.id
         ]
-    finally:
-        db.close()
 
     warnings = await knowledge_service.check_interactions(medication.name, existing_names)
     if warnings:
@@ -85,7 +116,8 @@ def _format_med_message(med: Medication) -> str:
         details.append(med.form)
     lines.append(" · ".join(details) if details else "Форма: не указана")
     lines.append(f"Категория: {med.category or '—'}")
-    lines.append(f"Остаток: {med.stock_remaining:g}")
+    left = _days_left_text(med) if not med.archived else None
+    lines.append(f"Остаток: {med.stock_remaining:g}" + (f" · {left}" if left else ""))
     lines.append(f"Статус: {'архив' if med.archived else 'активен'}")
     lines.append("")
     lines.append(f"Пополнить: /restock {med.id} 20  # добавит +20 доз")
@@ -94,12 +126,9 @@ def _format_med_message(med: Medication) -> str:
 
 
 async def list_meds(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    db = next(get_db())
-    try:
-        user = user_service.ensure_user(db, update.effective_user)
-        meds = medication_service.list_medications(db, user, include_archived=True)
-    finally:
-        db.close()
+    async with unit_of_work() as db:
+        user = await db.run_sync(user_service.ensure_user, update.effective_user)
+        meds = await db.run_sync(medication_service.list_medications, user, include_archived=True)
 
     if not meds:
         await update.message.reply_text("Пока нет лекарств. Используй /add_med.")
@@ -115,9 +144,8 @@ async def med_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     action, med_id = query.data.split(":")
     med_id = int(med_id)
 
-    db = next(get_db())
-    try:
-        medication = db.query(Medication).filter(Medication.id == med_id).first()
+    async with unit_of_work() as db:
+        medication = await db.run_sync(medication_service.get_medication, med_id)
         if not medication:
             await query.edit_message_text("Препарат не найден.")
             return
@@ -126,7 +154,7 @@ async def med_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             return
 
         if action == "med_history":
-            history = medication_service.get_restock_history(db, medication)
+            history = await db.run_sync(medication_service.get_restock_history, medication)
             if not history:
                 await query.edit_message_text("История пока пуста.")
                 return
@@ -136,12 +164,11 @@ async def med_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             )
             await query.edit_message_text(text)
         elif action == "med_toggle":
-            medication_service.toggle_archive(db, medication, not medication.archived)
-            await query.edit_message_text(
-                "Статус обновлён: {}".format("архив" if medication.archived else "активен")
-            )
-    finally:
-        db.close()
+            await db.run_sync(medication_service.toggle_archive, medication, not medication.archived)
+    if action == "med_toggle":
+        await query.edit_message_text(
+            "Статус обновлён: {}".format("архив" if medication.archived else "активен")
+        )
 
 
 async def restock_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -156,19 +183,19 @@ async def restock_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
     note = " ".join(context.args[2:]) if len(context.args) > 2 else None
 
-    db = next(get_db())
-    try:
-        medication = db.query(Medication).filter(Medication.id == med_id).first()
+    async with unit_of_work() as db:
+        medication = await db.run_sync(medication_service.get_medication, med_id)
         if not medication:
             await update.message.reply_text("Препарат не найден.")
             return
         if medication.user.telegram_id != update.effective_user.id:
             await update.message.reply_text("Недостаточно прав.")
             return
-        medication_service.restock_medication(db, medication, quantity, note)
+        await db.run_sync(medication_service.restock_medication, medication, quantity, note)
+        alert = await db.run_sync(medication_service.stock_alert_due, medication)
         snapshot = _format_med_message(medication)
-    finally:
-        db.close()
+    if alert:
+        submit_low_stock_alert(context.application.bot_data["send_queue"], update.effective_user.id, medication)
     await update.message.reply_text("Запас обновлён.")
     await update.message.reply_text(snapshot, reply_markup=_med_inline_keyboard(medication))
 
@@ -184,20 +211,19 @@ async def set_stock_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("ID и остаток должны быть числами.")
         return
 
-    db = next(get_db())
-    try:
-        medication = db.query(Medication).filter(Medication.id == med_id).first()
+    async with unit_of_work() as db:
+        medication = await db.run_sync(medication_service.get_medication, med_id)
         if not medication:
             await update.message.reply_text("Препарат не найден.")
             return
         if medication.user.telegram_id != update.effective_user.id:
             await update.message.reply_text("Недостаточно прав.")
             return
-        medication.stock_remaining = max(0.0, value)
-        db.commit()
+        await db.run_sync(medication_service.set_stock, medication, value)
+        alert = await db.run_sync(medication_service.stock_alert_due, medication)
         snapshot = _format_med_message(medication)
-    finally:
-        db.close()
+    if alert:
+        submit_low_stock_alert(context.application.bot_data["send_queue"], update.effective_user.id, medication)
     await update.message.reply_text(f"Остаток установлен: {value:g}")
     await update.message.reply_text(snapshot, reply_markup=_med_inline_keyboard(medication))
 
@@ -211,18 +237,15 @@ async def restock_history(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     except ValueError:
         await update.message.reply_text("ID должен быть числом.")
         return
-    db = next(get_db())
-    try:
-        medication = db.query(Medication).filter(Medication.id == med_id).first()
+    async with unit_of_work() as db:
+        medication = await db.run_sync(medication_service.get_medication, med_id)
         if not medication:
             await update.message.reply_text("Препарат не найден.")
             return
         if medication.user.telegram_id != update.effective_user.id:
             await update.message.reply_text("Недостаточно прав.")
             return
-        entries = medication_service.get_restock_history(db, medication)
-    finally:
-        db.close()
+        entries = await db.run_sync(medication_service.get_restock_history, medication)
 
     if not entries:
         await update.message.reply_text("История пуста.")
@@ -240,17 +263,14 @@ async def stock_edit_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     await query.answer()
     med_id = int(query.data.split(":")[1])
 
-    db = next(get_db())
-    try:
-        medication = db.query(Medication).filter(Medication.id == med_id).first()
+    async with unit_of_work() as db:
+        medication = await db.run_sync(medication_service.get_medication, med_id)
         if not medication:
             await query.edit_message_text("Препарат не найден.")
             return ConversationHandler.END
         if medication.user.telegram_id != query.from_user.id:
             await query.edit_message_text("Недостаточно прав.")
             return ConversationHandler.END
-    finally:
-        db.close()
 
     context.user_data[STOCK_EDIT_KEY] = med_id
     await query.message.reply_text(
@@ -281,9 +301,8 @@ async def stock_edit_apply(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         )
         return StockEditState.VALUE
 
-    db = next(get_db())
-    try:
-        medication = db.query(Medication).filter(Medication.id == med_id).first()
+    async with unit_of_work() as db:
+        medication = await db.run_sync(medication_service.get_medication, med_id)
         if not medication:
             await update.message.reply_text("Препарат не найден.")
             context.user_data.pop(STOCK_EDIT_KEY, None)
@@ -293,14 +312,13 @@ async def stock_edit_apply(update: Update, context: ContextTypes.DEFAULT_TYPE) -
             context.user_data.pop(STOCK_EDIT_KEY, None)
             return
         if delta is not None:
-            medication.stock_remaining = max(0.0, medication.stock_remaining + delta)
+            new_value = await db.run_sync(medication_service.adjust_stock, medication, delta)
         else:
-            medication.stock_remaining = max(0.0, absolute)
-        db.commit()
-        new_value = medication.stock_remaining
-    finally:
-        db.close()
+            new_value = await db.run_sync(medication_service.set_stock, medication, absolute)
+        alert = await db.run_sync(medication_service.stock_alert_due, medication)
     context.user_data.pop(STOCK_EDIT_KEY, None)
+    if alert:
+        submit_low_stock_alert(context.application.bot_data["send_queue"], update.effective_user.id, medication)
     await update.message.reply_text(
         f"Остаток обновлён. Текущее значение: {new_value:g}",
         reply_markup=ReplyKeyboardRemove(),
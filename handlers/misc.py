@@ -1,7 +1,7 @@
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import ContextTypes, ConversationHandler
 
-from database import get_db
+from database import unit_of_work
 from services import user_service
 from utils.messages import DISCLAIMER
 from utils.personality import personality_text
@@ -26,14 +26,11 @@ def _keyboard(onboarded: bool) -> ReplyKeyboardMarkup:
 
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    db = next(get_db())
-    try:
-        user = user_service.ensure_user(db, update.effective_user)
-        persona = user.bot_personality
-        display_name = user.name
-        onboarded = bool(user.goal)
-    finally:
-        db.close()
+    async with unit_of_work() as db:
+        user = await db.run_sync(user_service.ensure_user, update.effective_user)
+    persona = user.bot_personality
+    display_name = user.name
+    onboarded = bool(user.goal)
 
     text = personality_text(persona, "welcome", name=display_name) or "Привет!"
     keyboard = _keyboard(onboarded)
@@ -50,6 +47,7 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "💊 Добавить препарат: /add_med\n"
         "📦 Мои препараты: /meds\n"
         "⏰ Напоминания: /set_reminder\n"
+        "🍳 Отметить событие: /event [название]\n"
         "📈 Статистика: /stats\n"
         "🏅 Достижения: /achievements\n"
         "📤 Экспорт: /export [json|csv]\n"
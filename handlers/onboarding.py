@@ -9,7 +9,7 @@ from telegram import (
 )
 from telegram.ext import ContextTypes, ConversationHandler
 
-from database import get_db
+from database import unit_of_work
 from services import user_service
 from handlers.states import SetupState
 from utils.messages import DISCLAIMER, PERSONALITY_CHOICES
@@ -155,11 +155,10 @@ async def finalize_setup(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         if len(parts) >= 2 and parts[1].isdigit():
             weight = int(parts[1])
 
-    db = next(get_db())
-    try:
-        user = user_service.ensure_user(db, update.effective_user)
-        user_service.update_profile(
-            db,
+    async with unit_of_work() as db:
+        user = await db.run_sync(user_service.ensure_user, update.effective_user)
+        await db.run_sync(
+            user_service.update_profile,
             user,
             name=context.user_data.get("setup_name"),
             timezone=context.user_data.get("setup_timezone"),
@@ -168,8 +167,6 @@ async def finalize_setup(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             age=age,
             weight=weight,
         )
-    finally:
-        db.close()
 
     await update.message.reply_text(
         "Готово! Профиль настроен. Добавь препараты через /add_med и я начну заботу.",
@@ -1,7 +1,7 @@
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import ContextTypes, ConversationHandler
 
-from database import get_db
+from database import unit_of_work
 from handlers.states import ProfileEditState
 from services import user_service
 from utils.messages import DISCLAIMER
@@ -19,11 +19,8 @@ def _profile_keyboard() -> InlineKeyboardMarkup:
 
 
 async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    db = next(get_db())
-    try:
-        model = user_service.ensure_user(db, update.effective_user)
-    finally:
-        db.close()
+    async with unit_of_work() as db:
+        model = await db.run_sync(user_service.ensure_user, update.effective_user)
 
     message = (
         f"{DISCLAIMER}\n\n"
@@ -58,13 +55,10 @@ async def apply_profile_edit(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return ConversationHandler.END
 
     value = update.message.text.strip()
-    db = next(get_db())
-    try:
-        user = user_service.ensure_user(db, update.effective_user)
+    async with unit_of_work() as db:
+        user = await db.run_sync(user_service.ensure_user, update.effective_user)
         kwargs = {field if field != "timezone" else "timezone": value}
-        user_service.update_profile(db, user, **kwargs)
-    finally:
-        db.close()
+        await db.run_sync(user_service.update_profile, user, **kwargs)
 
     await update.message.reply_text("Профиль обновлён.", reply_markup=_profile_keyboard())
     return ConversationHandler.END
@@ -8,11 +8,16 @@ from telegram import (
     ReplyKeyboardRemove,
     Update,
 )
+from sqlalchemy.orm import joinedload
 from telegram.ext import ContextTypes, ConversationHandler
 
-from database import get_db
+from config import settings
+from database import unit_of_work
 from models import Reminder, User
 from services import achievement_service, medication_service, reminder_service, user_service
+from services.reminder_service import StatusChange
+from services.send_queue import Priority
+from handlers.medications import submit_low_stock_alert
 from handlers.states import ReminderState
 from utils.personality import personality_text
 
@@ -44,6 +49,12 @@ DAY_NAMES = {
     "sat": "сб",
     "sun": "вс",
 }
+ACTION_STATUSES = {"take": "taken", "skip": "missed"}
+ANSWER_TEXTS = {
+    "taken": "Засчитано! Так держать.",
+    "missed": "Записал пропуск. Я напомню позже.",
+    "skipped": "Приём уже отмечен как пропущенный.",
+}
 
 
 def _schedule_keyboard() -> InlineKeyboardMarkup:
@@ -87,12 +98,9 @@ def _parse_time(value: str) -> dt.time | None:
 
 
 async def start_reminder_setup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    db = next(get_db())
-    try:
-        user = user_service.ensure_user(db, update.effective_user)
-        meds = medication_service.list_medications(db, user)
-    finally:
-        db.close()
+    async with unit_of_work() as db:
+        user = await db.run_sync(user_service.ensure_user, update.effective_user)
+        meds = await db.run_sync(medication_service.list_medications, user)
 
     if not meds:
         await update.message.reply_text("Сначала добавь препарат через /add_med.")
@@ -211,21 +219,21 @@ async def handle_geo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 
 async def _finalize_reminder(update, context) -> int:
     payload = context.user_data.get("reminder_payload", {})
-    db = next(get_db())
-    try:
-        user = user_service.ensure_user(db, update.effective_user)
+    async with unit_of_work() as db:
+        user = await db.run_sync(user_service.ensure_user, update.effective_user)
         med_id = payload.get("med_id")
-        reminder = reminder_service.create_reminder(
-            db,
+        reminder = await db.run_sync(
+            reminder_service.create_reminder,
             user,
             payload,
             medication_id=med_id if med_id else None,
         )
-        scheduler = context.application.bot_data.get("reminder_scheduler")
-        if scheduler:
-            scheduler.schedule(reminder)
-    finally:
-        db.close()
+    scheduler = context.application.bot_data.get("reminder_scheduler")
+    if scheduler:
+        scheduler.schedule(reminder)
+    geofences = context.application.bot_data.get("geofences")
+    if geofences and reminder.schedule_type == "geo":
+        geofences.invalidate(user.id)
 
     schedule_type = payload.get("schedule_type", "fixed_time")
     summary = "Напоминание сохранено."
@@ -246,7 +254,7 @@ async def _finalize_reminder(update, context) -> int:
         label = payload.get("event_label", "событие")
         minutes = payload.get("offset_minutes", 0)
         delay = f"{minutes} мин" if minutes else "без задержки"
-        summary = f"Напомню после «{label}» ({delay})."
+        summary = f"Напомню после «{label}» ({delay}). Когда это случится, отправь /event {label}."
     elif schedule_type == "geo":
         summary = "Напомню, как только окажешься в сохранённой точке."
 
@@ -255,79 +263,237 @@ async def _finalize_reminder(update, context) -> int:
     return ConversationHandler.END
 
 
-def reminder_keyboard(log_id: int) -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup(
+async def _arm_events(context, db, user: User, label: str) -> list[Reminder]:
+    armed = await db.run_sync(reminder_service.arm_event_reminders, user, label)
+    scheduler = context.application.bot_data.get("reminder_scheduler")
+    if scheduler:
+        for reminder in armed:
+            scheduler.schedule(reminder)
+    return armed
+
+
+def _armed_text(label: str, armed: list[Reminder]) -> str:
+    if not armed:
+        return f"Нет напоминаний, которые ждут «{label}»."
+    if len(armed) == 1:
+        minutes = max(0, armed[0].offset_minutes or 0)
+        if minutes:
+            return f"Отметил «{label}». Напомню через {minutes} мин."
+        return f"Отметил «{label}». Напоминаю прямо сейчас."
+    return f"Отметил «{label}». Запланировано напоминаний: {len(armed)}."
+
+
+async def event_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    label = " ".join(context.args).strip() if context.args else ""
+    async with unit_of_work() as db:
+        user = await db.run_sync(user_service.ensure_user, update.effective_user)
+        if label:
+            text = _armed_text(label, await _arm_events(context, db, user, label))
+            keyboard = None
+        else:
+            waiting = {}
+            for reminder in await db.run_sync(reminder_service.get_event_reminders, user):
+                waiting.setdefault(reminder.event_label.strip().casefold(), reminder)
+            if not waiting:
+                await update.message.reply_text(
+                    "Нет напоминаний «после события». Создай их через /set_reminder."
+                )
+                return
+            text = "Что произошло?"
+            keyboard = InlineKeyboardMarkup(
+                [
+                    [InlineKeyboardButton(reminder.event_label, callback_data=f"event:{reminder.id}")]
+                    for reminder in waiting.values()
+                ]
+            )
+    await update.message.reply_text(text, reply_markup=keyboard)
+
+
+async def event_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    reminder_id = int(query.data.split(":")[1])
+
+    async with unit_of_work() as db:
+        user = await db.run_sync(user_service.ensure_user, update.effective_user)
+        reminder = await db.get(Reminder, reminder_id)
+        if not reminder or reminder.user_id != user.id or not reminder.event_label:
+            await query.edit_message_text("Напоминание не найдено.")
+            return
+        label = reminder.event_label
+        text = _armed_text(label, await _arm_events(context, db, user, label))
+    await query.edit_message_text(text)
+
+
+async def location_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Check shared locations, live updates included, against the user's geo reminders."""
+    location = update.effective_message.location
+    geofences = context.application.bot_data["geofences"]
+    async with unit_of_work() as db:
+        user = await db.run_sync(user_service.ensure_user, update.effective_user)
+        if user.id not in geofences:
+            geofences.load(user.id, await db.run_sync(reminder_service.get_geo_reminders, user))
+        entered = geofences.enter(user.id, location.latitude, location.longitude)
+        armed = await db.run_sync(
+            reminder_service.arm_geo_reminders,
+            user,
+            entered,
+            location.latitude,
+            location.longitude,
+            settings.geo_cooldown_min,
+        )
+    scheduler = context.application.bot_data.get("reminder_scheduler")
+    if scheduler:
+        for reminder in armed:
+            scheduler.schedule(reminder)
+
+
+def reminder_keyboard(log_id: int, can_snooze: bool = True) -> InlineKeyboardMarkup:
+    rows = [
         [
-            [
-                InlineKeyboardButton("Принял ✅", callback_data=f"rem_action:take:{log_id}"),
-                InlineKeyboardButton("Пропустил 🚫", callback_data=f"rem_action:skip:{log_id}"),
-            ],
+            InlineKeyboardButton("Принял ✅", callback_data=f"rem_action:take:{log_id}"),
+            InlineKeyboardButton("Пропустил 🚫", callback_data=f"rem_action:skip:{log_id}"),
+        ],
+    ]
+    if can_snooze:
+        rows.append(
             [
                 InlineKeyboardButton("Отложить 10м", callback_data=f"rem_snooze:{log_id}:10"),
                 InlineKeyboardButton("30м", callback_data=f"rem_snooze:{log_id}:30"),
                 InlineKeyboardButton("1ч", callback_data=f"rem_snooze:{log_id}:60"),
-            ],
+            ]
+        )
+    return InlineKeyboardMarkup(rows)
+
+
+def _reminder_text(reminder: Reminder, user: User) -> str:
+    return personality_text(
+        user.bot_personality,
+        "reminder",
+        med_name=reminder.medication.name if reminder.medication else reminder.label or "лекарство",
+        name=user.name,
+    ) or "Пора принять лекарство!"
+
+
+async def dispatch_reminders(
+    context: ContextTypes.DEFAULT_TYPE,
+    next_fires: dict[int, dt.datetime | None],
+    scheduled_for: dt.datetime,
+) -> None:
+    next_fires = {
+        reminder_id: next_fire.astimezone(dt.timezone.utc).replace(tzinfo=None) if next_fire else None
+        for reminder_id, next_fire in next_fires.items()
+    }
+    scheduler = context.application.bot_data["reminder_scheduler"]
+    # The lease is committed on its own so other workers skip these reminders
+    # while they are sent. If this process dies before the release below,
+    # next_fire_at still holds this occurrence: once the lease expires the
+    # next refill picks it up again under the catch-up policy.
+    async with unit_of_work() as db:
+        claimed = await db.run_sync(
+            reminder_service.claim_due_reminders,
+            next_fires,
+            scheduler.worker_id,
+            dt.datetime.utcnow(),
+            settings.reminder_lease_sec,
+        )
+    if not claimed:
+        return
+    scheduled_for = scheduled_for.replace(tzinfo=None)
+    async with unit_of_work() as db:
+        due = await db.run_sync(reminder_service.load_due_reminders, claimed)
+        outgoing = [
+            (
+                reminder.id,
+                reminder.user.telegram_id,
+                _reminder_text(reminder, reminder.user),
+                reminder.snooze_limit is None or reminder.snooze_limit > 0,
+            )
+            for reminder in due
         ]
-    )
-
+        log_ids = await db.run_sync(reminder_service.log_reminders, due, scheduled_for)
+
+    send_queue = context.application.bot_data["send_queue"]
+    for reminder_id, chat_id, text, can_snooze in outgoing:
+        send_queue.submit(
+            chat_id,
+            text,
+            priority=Priority.DOSE,
+            collapse_key=f"reminder:{reminder_id}",
+            reply_markup=reminder_keyboard(log_ids[reminder_id], can_snooze),
+        )
 
-async def reminder_job_callback(context: ContextTypes.DEFAULT_TYPE) -> None:
-    reminder_id = context.job.data.get("reminder_id")
-    manual_log_id = context.job.data.get("log_id")
-    db = next(get_db())
-    try:
-        reminder = db.query(Reminder).filter(Reminder.id == reminder_id).first()
-        if not reminder or not reminder.active:
-            return
-        user = db.query(User).filter(User.id == reminder.user_id).first()
-        if not user:
-            return
-        if manual_log_id:
-            log = reminder_service.get_log(db, manual_log_id)
-        else:
-            log = None
-        if not log:
-            scheduled_for = dt.datetime.utcnow()
-            log = reminder_service.log_reminder(db, reminder, scheduled_for)
-        text = personality_text(
-            user.bot_personality,
-            "reminder",
-            med_name=reminder.medication.name if reminder.medication else reminder.label or "лекарство",
-            name=user.name,
-        ) or "Пора принять лекарство!"
-        await context.bot.send_message(
-            chat_id=user.telegram_id,
-            text=text,
-            reply_markup=reminder_keyboard(log.id),
+    async with unit_of_work() as db:
+        await db.run_sync(
+            reminder_service.release_reminders,
+            scheduler.worker_id,
+            scheduled_for,
+            {reminder_id: next_fires.get(reminder_id) for reminder_id in claimed},
         )
-        if reminder.nag_enabled:
-            context.job_queue.run_once(
-                nag_callback,
-                when=reminder.nag_interval_minutes * 60,
-                data={"log_id": log.id},
-                name=f"nag::{log.id}",
-            )
-    finally:
-        db.close()
 
 
-async def nag_callback(context: ContextTypes.DEFAULT_TYPE) -> None:
-    log_id = context.job.data.get("log_id")
-    db = next(get_db())
-    try:
-        log = reminder_service.get_log(db, log_id)
-        if not log or log.status != "pending":
-            return
-        user = db.query(User).filter(User.id == log.user_id).first()
-        if not user:
-            return
-        await context.bot.send_message(
-            chat_id=user.telegram_id,
-            text="Напоминаю, что приём ещё не подтверждён.",
-            reply_markup=reminder_keyboard(log.id),
+async def flush_log_changes(changes: list[StatusChange]) -> None:
+    async with unit_of_work() as db:
+        took = await db.run_sync(reminder_service.apply_status_changes, changes)
+        for user_id in took:
+            user = await db.get(User, user_id)
+            await db.run_sync(achievement_service.evaluate_user, user)
+
+
+def _buffered_status(context: ContextTypes.DEFAULT_TYPE, log_id: int) -> str | None:
+    """Latest answer to the log still waiting in the log buffer, if any."""
+    buffer = context.application.bot_data.get("log_buffer")
+    statuses = [change.status for change in buffer.pending() if change.log_id == log_id] if buffer else []
+    return statuses[-1] if statuses else None
+
+
+def _answered_log_ids(context: ContextTypes.DEFAULT_TYPE) -> set[int]:
+    """Logs answered in this process whose changes are not written yet."""
+    buffer = context.application.bot_data.get("log_buffer")
+    return {change.log_id for change in buffer.pending()} if buffer else set()
+
+
+async def due_log_sweep_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    now = dt.datetime.utcnow()
+    outgoing = []
+    answered = _answered_log_ids(context)
+    async with unit_of_work() as db:
+        for log in await db.run_sync(reminder_service.claim_due_logs, now):
+            if log.id in answered:
+                continue
+            reminder = log.reminder
+            can_snooze = reminder_service.can_snooze(log, reminder)
+            if log.status == "pending":
+                outgoing.append(
+                    (
+                        log.user.telegram_id,
+                        "Напоминаю, что приём ещё не подтверждён.",
+                        Priority.NAG,
+                        f"nag:{log.id}",
+                        reminder_keyboard(log.id, can_snooze),
+                    )
+                )
+            elif reminder.active:
+                reminder_service.mark_delivered(log, now)
+                outgoing.append(
+                    (
+                        log.user.telegram_id,
+                        _reminder_text(reminder, log.user),
+                        Priority.DOSE,
+                        f"reminder:{reminder.id}",
+                        reminder_keyboard(log.id, can_snooze),
+                    )
+                )
+
+    send_queue = context.application.bot_data["send_queue"]
+    for chat_id, text, priority, collapse_key, keyboard in outgoing:
+        send_queue.submit(
+            chat_id,
+            text,
+            priority=priority,
+            collapse_key=collapse_key,
+            reply_markup=keyboard,
         )
-    finally:
-        db.close()
 
 
 async def reminder_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -336,25 +502,30 @@ async def reminder_action(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     _, action, log_id = query.data.split(":")
     log_id = int(log_id)
 
-    db = next(get_db())
-    try:
-        log = reminder_service.get_log(db, log_id)
+    status = ACTION_STATUSES.get(action)
+    if not status:
+        return
+    text = ANSWER_TEXTS[status]
+
+    async with unit_of_work() as db:
+        log = await db.run_sync(reminder_service.get_log, log_id)
         if not log:
             await query.edit_message_text("Запись не найдена.")
             return
-        reminder = db.query(Reminder).filter(Reminder.id == log.reminder_id).first()
-        user = db.query(User).filter(User.id == log.user_id).first()
-        if action == "take":
-            reminder_service.update_log_status(db, log, "taken")
-            if reminder and reminder.medication:
-                medication_service.consume_dose(db, reminder.medication)
-            achievement_service.evaluate_user(db, user)
-            await query.edit_message_text("Засчитано! Так держать.")
-        elif action == "skip":
-            reminder_service.update_log_status(db, log, "missed")
-            await query.edit_message_text("Записал пропуск. Я напомню позже.")
-    finally:
-        db.close()
+        if (_buffered_status(context, log_id) or log.status) == status:
+            # A repeated tap: the dose was already counted.
+            await query.edit_message_text(text)
+            return
+        reminder = await db.get(Reminder, log.reminder_id, options=[joinedload(Reminder.medication)])
+        alert = False
+        if status == "taken" and reminder and reminder.medication:
+            await db.run_sync(medication_service.consume_dose, reminder.medication)
+            alert = await db.run_sync(medication_service.stock_alert_due, reminder.medication)
+    if alert:
+        submit_low_stock_alert(context.application.bot_data["send_queue"], query.from_user.id, reminder.medication)
+    # The answer itself is written in bulk with others by the log buffer.
+    await context.application.bot_data["log_buffer"].put(StatusChange(log_id, status, dt.datetime.utcnow()))
+    await query.edit_message_text(text)
 
 
 async def reminder_snooze(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -364,24 +535,31 @@ async def reminder_snooze(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     log_id = int(log_id)
     minutes = int(minutes)
 
-    db = next(get_db())
-    try:
-        log = reminder_service.get_log(db, log_id)
+    async with unit_of_work() as db:
+        log = await db.run_sync(reminder_service.get_log, log_id)
         if not log:
             await query.edit_message_text("Напоминание не найдено.")
             return
-        reminder = db.query(Reminder).filter(Reminder.id == log.reminder_id).first()
+        status = _buffered_status(context, log_id) or log.status
+        if status == "snoozed":
+            # A repeated tap: the follow-up is already queued.
+            await query.edit_message_text(f"Отложил на {minutes} мин.")
+            return
+        if status in ANSWER_TEXTS:
+            # The dose is already answered; a stale snooze button must not reopen it.
+            await query.edit_message_text(ANSWER_TEXTS[status])
+            return
+        reminder = await db.get(Reminder, log.reminder_id)
         if not reminder:
             await query.edit_message_text("Напоминание удалено.")
             return
-        reminder_service.update_log_status(db, log, "snoozed")
-        new_time = dt.datetime.utcnow() + dt.timedelta(minutes=minutes)
-        new_log = reminder_service.log_reminder(db, reminder, new_time)
-        context.job_queue.run_once(
-            reminder_job_callback,
-            when=minutes * 60,
-            data={"reminder_id": reminder.id, "log_id": new_log.id},
-        )
-    finally:
-        db.close()
+        if not reminder_service.can_snooze(log, reminder):
+            await query.edit_message_text(
+                "Откладывать больше нельзя. Отметь, принял ли ты лекарство.",
+                reply_markup=reminder_keyboard(log.id, can_snooze=False),
+            )
+            return
+    await context.application.bot_data["log_buffer"].put(
+        StatusChange(log_id, "snoozed", dt.datetime.utcnow(), snooze_minutes=minutes)
+    )
     await query.edit_message_text(f"Отложил на {minutes} мин.")
@@ -16,6 +16,7 @@ class ReminderState(IntEnum):
     DAYS = auto()
     INTERVAL = auto()
     EVENT = auto()
+    GEO = auto()
     CONFIRM = auto()
 
 
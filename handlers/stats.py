@@ -1,18 +1,23 @@
 from telegram import Update
 from telegram.ext import ContextTypes
 
-from database import get_db
+from database import unit_of_work
 from services import achievement_service, export_service, stats_service, user_service
 
 
+async def _flush_answers(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Write buffered reminder answers so the user sees their latest taps."""
+    buffer = context.application.bot_data.get("log_buffer")
+    if buffer:
+        await buffer.flush()
+
+
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    db = next(get_db())
-    try:
-        user = user_service.ensure_user(db, update.effective_user)
-        summary = stats_service.adherence_summary(db, user)
-        chart = stats_service.weekly_plot(db, user)
-    finally:
-        db.close()
+    await _flush_answers(context)
+    async with unit_of_work() as db:
+        user = await db.run_sync(user_service.ensure_user, update.effective_user)
+        summary = await db.run_sync(stats_service.adherence_summary, user)
+        chart = await db.run_sync(stats_service.weekly_plot, user)
 
     text = (
         f"Соблюдение: {summary['adherence']}%\n"
@@ -21,31 +26,29 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     await update.message.reply_photo(chart, caption=text)
 
 
+def awards_text(awards) -> str:
+    lines = [f"{award.icon or '🎖'} {award.title}" for award in awards]
+    return "Новые достижения:\n" + "\n".join(lines)
+
+
 async def achievements_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    db = next(get_db())
-    try:
-        user = user_service.ensure_user(db, update.effective_user)
-        new_awards = achievement_service.evaluate_user(db, user)
-    finally:
-        db.close()
+    await _flush_answers(context)
+    async with unit_of_work() as db:
+        user = await db.run_sync(user_service.ensure_user, update.effective_user)
+        new_awards = await db.run_sync(achievement_service.evaluate_user, user)
 
     if new_awards:
-        lines = [f"{award.icon or '🎖'} {award.title}" for award in new_awards]
-        await update.message.reply_text("Новые достижения:\n" + "\n".join(lines))
+        await update.message.reply_text(awards_text(new_awards))
     else:
         await update.message.reply_text("Пока новых достижений нет, но прогресс продолжает расти!")
 
 
 async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await _flush_answers(context)
     fmt = context.args[0].lower() if context.args else "json"
-    db = next(get_db())
-    try:
-        user = user_service.ensure_user(db, update.effective_user)
-        if fmt == "csv":
-            filename, payload = export_service.export_csv(db, user)
-        else:
-            filename, payload = export_service.export_json(db, user)
-    finally:
-        db.close()
+    async with unit_of_work() as db:
+        user = await db.run_sync(user_service.ensure_user, update.effective_user)
+        export = export_service.export_csv if fmt == "csv" else export_service.export_json
+        filename, payload = await db.run_sync(export, user)
 
     await update.message.reply_document(document=payload, filename=filename)
@@ -1,10 +1,12 @@
 import asyncio
+import datetime as dt
 import logging
 import os
 import re
+import signal
+import sys
 from functools import partial
 
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
     CallbackQueryHandler,
@@ -15,7 +17,7 @@ from telegram.ext import (
 )
 
 from config import settings
-from database import get_db, init_db
+from database import SessionLocal, init_db, unit_of_work
 from handlers import (
     SetupState,
     ReminderState,
@@ -29,9 +31,11 @@ from handlers import (
     lifestyle,
     misc,
 )
-from models import Medication
-from services import medication_service, reminder_service
+from services import achievement_service, log_store, medication_service, reminder_service, stock_forecast
+from services.geofence import GeofenceIndex
 from services.reminder_scheduler import ReminderScheduler
+from services.send_queue import Priority, SendQueue
+from services.write_buffer import WriteBuffer
 
 logging.basicConfig(
     level=logging.INFO,
@@ -40,51 +44,97 @@ logging.basicConfig(
 logger = logging.getLogger("health_buddy")
 
 
-async def stock_watch_job(context):
-    notified = context.application.bot_data.setdefault("low_stock_notified", set())
-    db = next(get_db())
-    try:
-        meds = db.query(Medication).filter(Medication.archived.is_(False)).all()
-        for med in meds:
-            if medication_service.is_low_stock(med):
-                if med.id in notified:
-                    continue
-                text = (
-                    f"Заканчивается {med.name}. Осталось всего {med.stock_remaining}."
-                    "\nЧто делаем?"
-                )
-                keyboard = InlineKeyboardMarkup(
-                    [
-                        [
-                            InlineKeyboardButton(
-                                "Найти аптеки",
-                                url="https://www.google.com/maps/search/%D0%B0%D0%BF%D1%82%D0%B5%D0%BA%D0%B0/",
-                            ),
-                            InlineKeyboardButton(
-                                "Изменить остаток",
-                                callback_data=f"med_stock:{med.id}",
-                            ),
-                        ]
-                    ]
-                )
-                await context.bot.send_message(
-                    chat_id=med.user.telegram_id,
-                    text=text,
-                    reply_markup=keyboard,
-                )
-                notified.add(med.id)
-            else:
-                notified.discard(med.id)
-    finally:
-        db.close()
-
-
-def build_application() -> Application:
+async def stock_reconcile_job(context):
+    """Catch stock changes that bypassed the services, e.g. manual SQL."""
+    async with unit_of_work() as db:
+        meds = await db.run_sync(medication_service.claim_low_stock)
+    send_queue = context.application.bot_data["send_queue"]
+    for med in meds:
+        medications.submit_low_stock_alert(send_queue, med.user.telegram_id, med)
+
+
+async def reminder_refill_job(context):
+    scheduler = context.application.bot_data["reminder_scheduler"]
+    until = dt.datetime.utcnow() + scheduler.horizon
+    async with unit_of_work() as db:
+        added = await db.run_sync(
+            lambda session: scheduler.refill(reminder_service.upcoming_reminders(session, until))
+        )
+    logger.info("Reminder horizon refilled: %d added, %d scheduled", added, len(scheduler))
+
+
+async def log_retention_job(context):
+    now = dt.datetime.utcnow()
+    async with unit_of_work() as db:
+        await db.run_sync(log_store.ensure_partitions, now)
+    if settings.log_retention_days <= 0:
+        return
+    cutoff = now - dt.timedelta(days=settings.log_retention_days)
+    archived = 0
+    while True:
+        async with unit_of_work() as db:
+            moved = await db.run_sync(log_store.archive_logs, cutoff)
+        archived += moved
+        if moved < log_store.ARCHIVE_BATCH_SIZE:
+            break
+    async with unit_of_work() as db:
+        dropped = await db.run_sync(log_store.drop_archived_partitions, cutoff)
+    if archived or dropped:
+        logger.info("Archived %d reminder logs, dropped partitions: %s", archived, dropped or "none")
+
+
+async def achievement_batch_job(context):
+    async with unit_of_work() as db:
+        awards = await db.run_sync(achievement_service.evaluate_all)
+    send_queue = context.application.bot_data["send_queue"]
+    for telegram_id, entries in awards:
+        send_queue.submit(telegram_id, stats.awards_text(entries), priority=Priority.NOTICE, ttl=6 * 3600)
+    if awards:
+        logger.info("Nightly achievements awarded to %d users", len(awards))
+
+
+async def stock_forecast_job(context):
+    async with unit_of_work() as db:
+        forecasts = await db.run_sync(stock_forecast.rebuild)
+    logger.info("Stock forecasts: %d medications with a run-out day", forecasts)
+
+
+WRITE_BUFFERS = ("log_buffer", "tracker_buffer")
+
+
+async def start_background(application: Application) -> None:
+    application.bot_data["send_queue"].start()
+    for name in WRITE_BUFFERS:
+        if name in application.bot_data:
+            application.bot_data[name].start()
+
+
+async def stop_background(application: Application) -> None:
+    # Runs after the application stops but before the bot's HTTP client is
+    # closed: buffered writes are flushed, then queued messages are sent.
+    for name in WRITE_BUFFERS:
+        if name in application.bot_data:
+            await application.bot_data[name].stop()
+    await application.bot_data["send_queue"].stop()
+
+
+def build_application(worker: bool = False) -> Application:
     if not settings.bot_token or settings.bot_token == "YOUR_TOKEN":
         raise RuntimeError("TELEGRAM_TOKEN не задан.")
 
     init_db()
-    application = Application.builder().token(settings.bot_token).build()
+    with SessionLocal() as session:
+        achievement_service.sync_catalog(session)
+        session.commit()
+    application = (
+        Application.builder()
+        .token(settings.bot_token)
+        .post_init(start_background)
+        .post_stop(stop_background)
+        .build()
+    )
+    application.bot_data["send_queue"] = SendQueue(application.bot)
+    application.bot_data["geofences"] = GeofenceIndex()
 
     # Basic commands
     application.add_handler(CommandHandler("start", misc.start_command))
@@ -101,6 +151,7 @@ def build_application() -> Application:
     application.add_handler(CommandHandler("symptom", lifestyle.symptom_command))
     application.add_handler(CommandHandler("mood", lifestyle.mood_command))
     application.add_handler(CommandHandler("water", lifestyle.water_command))
+    application.add_handler(CommandHandler("event", reminders.event_command))
 
     shortcut_setup_regex = filters.Regex(f"^{re.escape(misc.SETUP_BUTTON)}$")
     shortcut_add_regex = filters.Regex(f"^{re.escape(misc.ADD_BUTTON)}$")
@@ -140,6 +191,7 @@ def build_application() -> Application:
             ReminderState.DAYS: [MessageHandler(filters.TEXT & ~filters.COMMAND, reminders.handle_days)],
             ReminderState.INTERVAL: [MessageHandler(filters.TEXT & ~filters.COMMAND, reminders.handle_interval)],
             ReminderState.EVENT: [MessageHandler(filters.TEXT & ~filters.COMMAND, reminders.handle_event)],
+            ReminderState.GEO: [MessageHandler(filters.LOCATION, reminders.handle_geo)],
         },
         fallbacks=[CommandHandler("cancel", misc.cancel)],
     )
@@ -167,37 +219,95 @@ def build_application() -> Application:
     application.add_handler(CallbackQueryHandler(medications.med_callback, pattern="^med_"))
     application.add_handler(CallbackQueryHandler(reminders.reminder_action, pattern="^rem_action:"))
     application.add_handler(CallbackQueryHandler(reminders.reminder_snooze, pattern="^rem_snooze:"))
+    application.add_handler(CallbackQueryHandler(reminders.event_callback, pattern="^event:"))
 
     # WebApp payload
     application.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, medications.handle_webapp_payload))
     application.add_handler(MessageHandler(filters.PHOTO, misc.handle_photo))
+    application.add_handler(MessageHandler(filters.LOCATION, reminders.location_update))
     application.add_handler(MessageHandler(shortcut_add_regex, medications.add_med_command))
     application.add_handler(MessageHandler(shortcut_list_regex, medications.list_meds))
     application.add_handler(MessageHandler(shortcut_reminder_regex, reminders.start_reminder_setup))
     application.add_handler(MessageHandler(shortcut_stats_regex, stats.stats_command))
 
-    scheduler = ReminderScheduler(application.job_queue, reminders.reminder_job_callback)
+    scheduler = ReminderScheduler(application.job_queue, reminders.dispatch_reminders)
     application.bot_data["reminder_scheduler"] = scheduler
-    db = next(get_db())
-    try:
-        for reminder in reminder_service.upcoming_reminders(db):
-            scheduler.schedule(reminder)
-    finally:
-        db.close()
-
     application.job_queue.run_repeating(
-        stock_watch_job,
-        interval=1800,
-        first=30,
-        name="stock-watch",
+        reminders.due_log_sweep_job,
+        interval=settings.reminder_tick_sec,
+        first=settings.reminder_tick_sec,
+        name="due-log-sweep",
     )
+    application.job_queue.run_repeating(
+        reminder_refill_job,
+        interval=settings.reminder_refill_interval_sec,
+        first=1,
+        name="reminder-refill",
+    )
+
+    if not worker:
+        application.bot_data["log_buffer"] = WriteBuffer(
+            reminders.flush_log_changes,
+            interval=settings.log_flush_interval_ms / 1000,
+            max_items=settings.log_flush_max_rows,
+            name="log-buffer",
+        )
+        application.bot_data["tracker_buffer"] = WriteBuffer(
+            lifestyle.flush_entries,
+            interval=settings.tracker_flush_interval_ms / 1000,
+            max_items=settings.tracker_buffer_size // 10,
+            max_pending=settings.tracker_buffer_size,
+            name="tracker-buffer",
+        )
+        if settings.stock_reconcile_sec > 0:
+            application.job_queue.run_repeating(
+                stock_reconcile_job,
+                interval=settings.stock_reconcile_sec,
+                first=30,
+                name="stock-reconcile",
+            )
+        application.job_queue.run_repeating(
+            log_retention_job,
+            interval=24 * 3600,
+            first=120,
+            name="log-retention",
+        )
+        application.job_queue.run_daily(
+            stock_forecast_job,
+            time=dt.time(hour=settings.forecast_batch_hour, tzinfo=dt.timezone.utc),
+            name="stock-forecast",
+        )
+        application.job_queue.run_daily(
+            achievement_batch_job,
+            time=dt.time(hour=settings.achievement_batch_hour, tzinfo=dt.timezone.utc),
+            name="achievement-batch",
+        )
 
     return application
 
 
+async def run_worker(application: Application) -> None:
+    """Deliver reminders without polling Telegram for updates."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    async with application:
+        await start_background(application)
+        await application.start()
+        logger.info("Reminder worker %s started", application.bot_data["reminder_scheduler"].worker_id)
+        await stop.wait()
+        await application.stop()
+        await stop_background(application)
+
+
 def main():
-    application = build_application()
-    application.run_polling()
+    worker = "--worker" in sys.argv[1:]
+    application = build_application(worker=worker)
+    if worker:
+        asyncio.run(run_worker(application))
+    else:
+        application.run_polling()
 
 
 if __name__ == "__main__":
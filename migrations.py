@@ -0,0 +1,408 @@
+"""Versioned schema migrations applied at startup after ``create_all``.
+
+``create_all`` builds missing tables with their current columns and indexes;
+migrations bring databases created by older versions up to date. Each one
+runs in its own transaction and is recorded in ``schema_migrations``, so it
+is applied once. Migrations must tolerate a schema that ``create_all``
+already brought up to date.
+"""
+import datetime as dt
+import itertools
+import json
+import logging
+import zlib
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection, Engine
+
+logger = logging.getLogger(__name__)
+
+# Key of the PostgreSQL advisory lock taken while migrating, so that the bot
+# and worker processes starting together do not run the same migration.
+LOCK_KEY = 0x4842_4D49
+
+metadata = sa.MetaData()
+schema_migrations = sa.Table(
+    "schema_migrations",
+    metadata,
+    sa.Column("version", sa.Integer, primary_key=True),
+    sa.Column("name", sa.String, nullable=False),
+    sa.Column("applied_at", sa.DateTime, nullable=False),
+)
+
+
+def _create_index(conn: Connection, name: str, table: str, columns: Sequence[str]) -> None:
+    conn.execute(sa.text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({', '.join(columns)})"))
+
+
+def _add_columns(conn: Connection, table: str, columns: Dict[str, str]) -> None:
+    existing = {column["name"] for column in sa.inspect(conn).get_columns(table)}
+    for name, ddl in columns.items():
+        if name not in existing:
+            conn.execute(sa.text(f"ALTER TABLE {table} ADD COLUMN {name} {ddl}"))
+
+
+def _hot_query_indexes(conn: Connection) -> None:
+    _create_index(conn, "ix_reminder_logs_user_scheduled", "reminder_logs", ("user_id", "scheduled_for"))
+    _create_index(conn, "ix_reminder_logs_status_scheduled", "reminder_logs", ("status", "scheduled_for"))
+    _create_index(conn, "ix_medications_user_archived", "medications", ("user_id", "archived"))
+    _create_index(
+        conn, "ix_medication_restocks_medication_created", "medication_restocks", ("medication_id", "created_at")
+    )
+    _create_index(conn, "ix_symptom_logs_user_logged", "symptom_logs", ("user_id", "logged_at"))
+
+
+def _legacy_columns(conn: Connection) -> None:
+    """Columns and indexes that used to be added by one-off scripts."""
+    _add_columns(conn, "users", {"profile_update_notifications": "BOOLEAN DEFAULT TRUE"})
+    _add_columns(
+        conn,
+        "reminders",
+        {
+            "next_fire_at": "TIMESTAMP",
+            "last_fired_at": "TIMESTAMP",
+            "lease_owner": "VARCHAR",
+            "lease_until": "TIMESTAMP",
+        },
+    )
+    _add_columns(
+        conn,
+        "reminder_logs",
+        {"due_at": "TIMESTAMP", "snooze_count": "INTEGER NOT NULL DEFAULT 0"},
+    )
+    _create_index(conn, "ix_reminders_next_fire_at", "reminders", ("next_fire_at",))
+    _create_index(conn, "ix_reminders_user_event", "reminders", ("user_id", "event_label"))
+    _create_index(conn, "ix_reminder_logs_due_at", "reminder_logs", ("due_at",))
+    # Event and geo reminders used to fire hourly; now they wait to be armed.
+    conn.execute(
+        sa.text(
+            "UPDATE reminders SET next_fire_at = NULL "
+            "WHERE schedule_type IN ('event', 'geo') AND next_fire_at IS NOT NULL"
+        )
+    )
+
+
+def _partition_reminder_logs(conn: Connection) -> None:
+    """Turn reminder_logs into a table partitioned by month of scheduled_for."""
+    if conn.dialect.name != "postgresql":
+        return
+    from services.log_store import PARTITION_PREFIX, month_start, next_month, partition_ddl
+
+    conn.execute(sa.text("ALTER TABLE reminder_logs RENAME TO reminder_logs_legacy"))
+    conn.execute(
+        sa.text(
+            "CREATE TABLE reminder_logs (LIKE reminder_logs_legacy INCLUDING DEFAULTS) "
+            "PARTITION BY RANGE (scheduled_for)"
+        )
+    )
+    now = dt.datetime.utcnow()
+    first = conn.scalar(sa.text("SELECT min(scheduled_for) FROM reminder_logs_legacy")) or now
+    month, last = month_start(first), next_month(next_month(month_start(now)))
+    while month <= last:
+        conn.execute(sa.text(partition_ddl(month)))
+        month = next_month(month)
+    conn.execute(sa.text(f"CREATE TABLE {PARTITION_PREFIX}default PARTITION OF reminder_logs DEFAULT"))
+    conn.execute(sa.text("INSERT INTO reminder_logs SELECT * FROM reminder_logs_legacy"))
+
+    sequence = conn.scalar(sa.text("SELECT pg_get_serial_sequence('reminder_logs_legacy', 'id')"))
+    if sequence:
+        conn.execute(sa.text(f"ALTER SEQUENCE {sequence} OWNED BY NONE"))
+    conn.execute(sa.text("DROP TABLE reminder_logs_legacy"))
+    if sequence:
+        conn.execute(sa.text(f"ALTER SEQUENCE {sequence} OWNED BY reminder_logs.id"))
+    # Unique constraints on a partitioned table must include the partition key.
+    conn.execute(sa.text("ALTER TABLE reminder_logs ADD PRIMARY KEY (id, scheduled_for)"))
+    conn.execute(sa.text("ALTER TABLE reminder_logs ADD FOREIGN KEY (reminder_id) REFERENCES reminders (id)"))
+    conn.execute(sa.text("ALTER TABLE reminder_logs ADD FOREIGN KEY (user_id) REFERENCES users (id)"))
+    _create_index(conn, "ix_reminder_logs_id", "reminder_logs", ("id",))
+    _create_index(conn, "ix_reminder_logs_due_at", "reminder_logs", ("due_at",))
+    _create_index(conn, "ix_reminder_logs_user_scheduled", "reminder_logs", ("user_id", "scheduled_for"))
+    _create_index(conn, "ix_reminder_logs_status_scheduled", "reminder_logs", ("status", "scheduled_for"))
+
+
+# Data migrations read and write through these column lists rather than the
+# ORM models, so that columns added by later migrations are never selected
+# from a database that does not have them yet.
+def _table(name: str, **columns) -> sa.TableClause:
+    return sa.table(name, *(sa.column(column, type_) for column, type_ in columns.items()))
+
+
+_ADHERENCE_COUNTS = ("taken", "missed", "skipped", "snoozed", "pending")
+_reminders = _table(
+    "reminders",
+    id=sa.Integer,
+    user_id=sa.Integer,
+    medication_id=sa.Integer,
+    timezone=sa.String,
+    active=sa.Boolean,
+    schedule_type=sa.String,
+    time_of_day=sa.Time,
+    days_of_week=sa.String,
+    interval_hours=sa.Integer,
+)
+_reminder_logs = _table(
+    "reminder_logs",
+    id=sa.Integer,
+    reminder_id=sa.Integer,
+    user_id=sa.Integer,
+    scheduled_for=sa.DateTime,
+    status=sa.String,
+)
+_reminder_log_archive = _table("reminder_log_archive", user_id=sa.Integer, payload=sa.LargeBinary)
+_medications = _table(
+    "medications",
+    id=sa.Integer,
+    stock_remaining=sa.Float,
+    dose_size=sa.Float,
+    archived=sa.Boolean,
+    daily_usage=sa.Float,
+    runs_out_on=sa.Date,
+)
+_daily_adherence = _table(
+    "daily_adherence",
+    user_id=sa.Integer,
+    medication_id=sa.Integer,
+    day=sa.Date,
+    **{column: sa.Integer for column in _ADHERENCE_COUNTS},
+)
+_user_streaks = _table(
+    "user_streaks",
+    user_id=sa.Integer,
+    current_streak=sa.Integer,
+    clean_since=sa.DateTime,
+    last_log_id=sa.Integer,
+    last_log_at=sa.DateTime,
+    active_reminders=sa.Integer,
+)
+
+
+def _archived_logs(conn: Connection) -> Iterator[Dict]:
+    """Rows of reminder_log_archive payloads as written by log_store.archive_logs."""
+    for (payload,) in conn.execution_options(yield_per=100).execute(sa.select(_reminder_log_archive.c.payload)):
+        yield from json.loads(zlib.decompress(payload))
+
+
+def _parse_time(value) -> dt.datetime:
+    return dt.datetime.fromisoformat(value) if isinstance(value, str) else value
+
+
+def _backfill_daily_adherence(conn: Connection, chunk_size: int = 1000) -> None:
+    from services.adherence_rollup import local_day, status_column
+
+    owners = {
+        reminder_id: (user_id, medication_id or 0, timezone)
+        for reminder_id, user_id, medication_id, timezone in conn.execute(
+            sa.select(_reminders.c.id, _reminders.c.user_id, _reminders.c.medication_id, _reminders.c.timezone)
+        )
+    }
+    insert = (postgresql if conn.dialect.name == "postgresql" else sqlite).insert(_daily_adherence)
+    upsert = insert.on_conflict_do_update(
+        index_elements=["user_id", "medication_id", "day"],
+        set_={column: _daily_adherence.c[column] + insert.excluded[column] for column in _ADHERENCE_COUNTS},
+    )
+    counts: Dict[Tuple[int, int, dt.date], Dict[str, int]] = {}
+
+    def write() -> None:
+        if counts:
+            conn.execute(
+                upsert,
+                [
+                    dict(
+                        {column: row.get(column, 0) for column in _ADHERENCE_COUNTS},
+                        user_id=user_id,
+                        medication_id=medication_id,
+                        day=day,
+                    )
+                    for (user_id, medication_id, day), row in counts.items()
+                ],
+            )
+            counts.clear()
+
+    conn.execute(sa.delete(_daily_adherence))
+    live = conn.execution_options(yield_per=chunk_size).execute(
+        sa.select(_reminder_logs.c.reminder_id, _reminder_logs.c.scheduled_for, _reminder_logs.c.status)
+    )
+    archived = ((row["reminder_id"], row["scheduled_for"], row["status"]) for row in _archived_logs(conn))
+    for reminder_id, scheduled_for, status in itertools.chain(live, archived):
+        owner = owners.get(reminder_id)
+        if owner is None:
+            continue
+        user_id, medication_id, timezone = owner
+        row = counts.setdefault((user_id, medication_id, local_day(_parse_time(scheduled_for), timezone)), {})
+        column = status_column(status)
+        row[column] = row.get(column, 0) + 1
+        if len(counts) >= chunk_size:
+            write()
+    write()
+
+
+def _new_streak(user_id: int, active_reminders: int = 0) -> Dict:
+    return {
+        "user_id": user_id,
+        "current_streak": 0,
+        "clean_since": None,
+        "last_log_id": None,
+        "last_log_at": None,
+        "active_reminders": active_reminders,
+    }
+
+
+def _backfill_user_streaks(conn: Connection) -> None:
+    """Replay answered logs, archived ones first, as streak_service does."""
+    answered = ("taken", "missed", "skipped")
+    owners = dict(conn.execute(sa.select(_reminders.c.id, _reminders.c.user_id)).all())
+    streaks: Dict[int, Dict] = {
+        user_id: _new_streak(user_id, count)
+        for user_id, count in conn.execute(
+            sa.select(_reminders.c.user_id, sa.func.count())
+            .where(_reminders.c.active.is_(True))
+            .group_by(_reminders.c.user_id)
+        )
+    }
+    archived = sorted(
+        (
+            (owners[row["reminder_id"]], row["id"], _parse_time(row["scheduled_for"]), row["status"])
+            for row in _archived_logs(conn)
+            if row["status"] in answered and row["reminder_id"] in owners
+        ),
+        key=lambda entry: entry[2],
+    )
+    live = conn.execution_options(yield_per=1000).execute(
+        sa.select(
+            _reminder_logs.c.user_id, _reminder_logs.c.id, _reminder_logs.c.scheduled_for, _reminder_logs.c.status
+        )
+        .where(_reminder_logs.c.status.in_(answered))
+        .order_by(_reminder_logs.c.scheduled_for)
+    )
+    for user_id, log_id, scheduled_for, status in itertools.chain(archived, live):
+        if user_id not in streaks:
+            streaks[user_id] = _new_streak(user_id)
+        streak = streaks[user_id]
+        if status == "taken":
+            streak["clean_since"] = streak["clean_since"] or scheduled_for
+            streak["current_streak"] += 1
+        else:
+            streak["clean_since"] = max(streak["clean_since"] or scheduled_for, scheduled_for)
+            streak["current_streak"] = 0
+        if streak["last_log_at"] is None or scheduled_for >= streak["last_log_at"]:
+            streak["last_log_id"], streak["last_log_at"] = log_id, scheduled_for
+    conn.execute(sa.delete(_user_streaks))
+    if streaks:
+        conn.execute(sa.insert(_user_streaks), list(streaks.values()))
+
+
+def _low_stock_flag(conn: Connection) -> None:
+    from config import settings
+
+    _add_columns(conn, "medications", {"low_stock_notified": "BOOLEAN NOT NULL DEFAULT FALSE"})
+    _create_index(
+        conn, "ix_medications_low_stock", "medications", ("low_stock_notified", "archived", "stock_remaining")
+    )
+    # Medications that are already low were alerted by the old in-memory
+    # scan; do not alert them again after the upgrade.
+    conn.execute(
+        sa.text("UPDATE medications SET low_stock_notified = TRUE WHERE stock_remaining <= :threshold"),
+        {"threshold": settings.low_stock_threshold},
+    )
+
+
+def _stock_forecast(conn: Connection) -> None:
+    import numpy as np
+
+    from services.stock_forecast import CALIBRATION_DAYS, daily_usage, doses_per_day, runs_out_on, today
+
+    _add_columns(conn, "medications", {"daily_usage": "FLOAT", "runs_out_on": "DATE"})
+    _create_index(
+        conn, "ix_medications_runs_out_on", "medications", ("low_stock_notified", "archived", "runs_out_on")
+    )
+    rows = conn.execute(
+        sa.select(_medications.c.id, _medications.c.stock_remaining, _medications.c.dose_size).where(
+            _medications.c.archived.is_(False)
+        )
+    ).all()
+    if not rows:
+        return
+    planned: Dict[int, float] = {}
+    for medication_id, *schedule in conn.execute(
+        sa.select(
+            _reminders.c.medication_id,
+            _reminders.c.schedule_type,
+            _reminders.c.time_of_day,
+            _reminders.c.days_of_week,
+            _reminders.c.interval_hours,
+        ).where(_reminders.c.active.is_(True), _reminders.c.medication_id.is_not(None))
+    ):
+        planned[medication_id] = planned.get(medication_id, 0.0) + doses_per_day(*schedule)
+    start = today()
+    logged = sum(_daily_adherence.c[column] for column in _ADHERENCE_COUNTS)
+    history = {
+        medication_id: (taken or 0, total or 0)
+        for medication_id, taken, total in conn.execute(
+            sa.select(_daily_adherence.c.medication_id, sa.func.sum(_daily_adherence.c.taken), sa.func.sum(logged))
+            .where(_daily_adherence.c.day >= start - dt.timedelta(days=CALIBRATION_DAYS))
+            .group_by(_daily_adherence.c.medication_id)
+        )
+    }
+    ids = [row[0] for row in rows]
+    stock = np.array([row[1] or 0.0 for row in rows], dtype=float)
+    counts = np.array([history.get(id_, (0, 0)) for id_ in ids], dtype=float).reshape(-1, 2)
+    usage = daily_usage(
+        np.array([row[2] or 0.0 for row in rows], dtype=float),
+        np.array([planned.get(id_, 0.0) for id_ in ids], dtype=float),
+        counts[:, 0],
+        counts[:, 1],
+    )
+    conn.execute(
+        sa.update(_medications)
+        .where(_medications.c.id == sa.bindparam("medication_id"))
+        .values(daily_usage=sa.bindparam("usage"), runs_out_on=sa.bindparam("runs_out")),
+        [
+            {"medication_id": id_, "usage": value or None, "runs_out": runs_out}
+            for id_, value, runs_out in zip(ids, usage.tolist(), runs_out_on(stock, usage, start))
+        ],
+    )
+
+
+MIGRATIONS: List[Tuple[int, str, Callable[[Connection], None]]] = [
+    (1, "hot query indexes", _hot_query_indexes),
+    (2, "reminder scheduling columns", _legacy_columns),
+    (3, "monthly reminder_logs partitions", _partition_reminder_logs),
+    (4, "daily adherence rollups", _backfill_daily_adherence),
+    (5, "user streaks", _backfill_user_streaks),
+    (6, "persisted low-stock alerts", _low_stock_flag),
+    (7, "run-out forecasts", _stock_forecast),
+]
+
+
+def run_migrations(engine: Engine) -> List[int]:
+    """Apply pending migrations in version order and return their versions."""
+    applied: List[int] = []
+    postgres = engine.dialect.name == "postgresql"
+    with engine.connect() as lock_conn:
+        if postgres:
+            lock_conn.execute(sa.text("SELECT pg_advisory_lock(:key)"), {"key": LOCK_KEY})
+            lock_conn.commit()
+        try:
+            metadata.create_all(engine)
+            for version, name, migrate in MIGRATIONS:
+                with engine.begin() as conn:
+                    done = conn.scalar(
+                        sa.select(schema_migrations.c.version).where(schema_migrations.c.version == version)
+                    )
+                    if done is not None:
+                        continue
+                    migrate(conn)
+                    conn.execute(
+                        schema_migrations.insert().values(
+                            version=version, name=name, applied_at=dt.datetime.utcnow()
+                        )
+                    )
+                logger.info("Applied migration %d: %s", version, name)
+                applied.append(version)
+        finally:
+            if postgres:
+                lock_conn.execute(sa.text("SELECT pg_advisory_unlock(:key)"), {"key": LOCK_KEY})
+                lock_conn.commit()
+    return applied
@@ -3,11 +3,14 @@ import uuid
 from sqlalchemy import (
     Boolean,
     Column,
+    Date,
     DateTime,
     Float,
     ForeignKey,
+    Index,
     Integer,
     BigInteger,
+    LargeBinary,
     String,
     Text,
     UniqueConstraint,
@@ -93,6 +96,9 @@ class Medication(Base, TimestampMixin):
     stock_remaining = Column(Float, default=0)
     notes = Column(Text, nullable=True)
     archived = Column(Boolean, default=False)
+    low_stock_notified = Column(Boolean, default=False, nullable=False)
+    daily_usage = Column(Float, nullable=True)
+    runs_out_on = Column(Date, nullable=True)
 
     user = relationship("User", back_populates="medications")
     reminders = relationship(
@@ -104,6 +110,12 @@ class Medication(Base, TimestampMixin):
         cascade="all, delete-orphan",
     )
 
+    __table_args__ = (
+        Index("ix_medications_user_archived", "user_id", "archived"),
+        Index("ix_medications_low_stock", "low_stock_notified", "archived", "stock_remaining"),
+        Index("ix_medications_runs_out_on", "low_stock_notified", "archived", "runs_out_on"),
+    )
+
 
 class MedicationRestock(Base):
     __tablename__ = "medication_restocks"
@@ -116,6 +128,10 @@ class MedicationRestock(Base):
 
     medication = relationship("Medication", back_populates="restocks")
 
+    __table_args__ = (
+        Index("ix_medication_restocks_medication_created", "medication_id", "created_at"),
+    )
+
 
 class Reminder(Base, TimestampMixin):
     __tablename__ = "reminders"
@@ -137,6 +153,10 @@ class Reminder(Base, TimestampMixin):
     nag_interval_minutes = Column(Integer, default=15)
     snooze_limit = Column(Integer, default=3)
     active = Column(Boolean, default=True)
+    next_fire_at = Column(DateTime, nullable=True, index=True)
+    last_fired_at = Column(DateTime, nullable=True)
+    lease_owner = Column(String, nullable=True)
+    lease_until = Column(DateTime, nullable=True)
 
     medication = relationship("Medication", back_populates="reminders")
     user = relationship("User", back_populates="reminders")
@@ -144,6 +164,10 @@ class Reminder(Base, TimestampMixin):
         "ReminderLog", back_populates="reminder", cascade="all, delete-orphan"
     )
 
+    __table_args__ = (
+        Index("ix_reminders_user_event", "user_id", "event_label"),
+    )
+
 
 class ReminderLog(Base):
     __tablename__ = "reminder_logs"
@@ -155,10 +179,70 @@ class ReminderLog(Base):
     status = Column(String, default="pending")
     taken_at = Column(DateTime, nullable=True)
     note = Column(String, nullable=True)
+    due_at = Column(DateTime, nullable=True, index=True)
+    snooze_count = Column(Integer, default=0, nullable=False)
 
     reminder = relationship("Reminder", back_populates="logs")
     user = relationship("User", back_populates="reminder_logs")
 
+    __table_args__ = (
+        Index("ix_reminder_logs_user_scheduled", "user_id", "scheduled_for"),
+        Index("ix_reminder_logs_status_scheduled", "status", "scheduled_for"),
+    )
+
+
+class DailyAdherence(Base):
+    """Reminder log counts per user, medication and local day of the reminder.
+
+    ``medication_id`` is 0 for reminders without a medication. ``pending``
+    also counts logs waiting for a snoozed delivery.
+    """
+
+    __tablename__ = "daily_adherence"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    medication_id = Column(Integer, primary_key=True, default=0)
+    day = Column(Date, primary_key=True)
+    taken = Column(Integer, default=0, nullable=False)
+    missed = Column(Integer, default=0, nullable=False)
+    skipped = Column(Integer, default=0, nullable=False)
+    snoozed = Column(Integer, default=0, nullable=False)
+    pending = Column(Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        Index("ix_daily_adherence_user_day", "user_id", "day"),
+    )
+
+
+class UserStreak(Base):
+    """Running no-miss streak of a user, updated as reminder logs are answered.
+
+    ``clean_since`` is the time of the last missed or skipped log, or of the
+    first taken one; ``current_streak`` counts doses taken since then.
+    """
+
+    __tablename__ = "user_streaks"
+
+    user_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    current_streak = Column(Integer, default=0, nullable=False)
+    clean_since = Column(DateTime, nullable=True)
+    last_log_id = Column(Integer, nullable=True)
+    last_log_at = Column(DateTime, nullable=True)
+    active_reminders = Column(Integer, default=0, nullable=False)
+
+
+class ReminderLogArchive(Base):
+    """Reminder logs past retention, one zlib-compressed JSON batch per user and month."""
+
+    __tablename__ = "reminder_log_archive"
+
+    id = Column(Integer, primary_key=True, index=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False, index=True)
+    period = Column(String, nullable=False)
+    row_count = Column(Integer, nullable=False)
+    payload = Column(LargeBinary, nullable=False)
+    archived_at = Column(DateTime, default=dt.datetime.utcnow)
+
 
 class SymptomLog(Base):
     __tablename__ = "symptom_logs"
@@ -173,6 +257,10 @@ class SymptomLog(Base):
     user = relationship("User", back_populates="symptoms")
     medication = relationship("Medication")
 
+    __table_args__ = (
+        Index("ix_symptom_logs_user_logged", "user_id", "logged_at"),
+    )
+
 
 class MoodLog(Base):
     __tablename__ = "mood_logs"
@@ -0,0 +1,33 @@
+"""Rebuild the daily adherence rollups from reminder logs.
+
+Usage: python -m scripts.backfill_adherence [telegram_id]
+
+Rollups are kept up to date as logs change; run this after editing logs by
+hand or to repair them. Without an argument every user is rebuilt.
+"""
+import sys
+
+from database import SessionLocal
+from models import User
+from services import adherence_rollup
+
+
+def main() -> None:
+    session = SessionLocal()
+    try:
+        user_id = None
+        if len(sys.argv) > 1:
+            user = session.query(User).filter(User.telegram_id == int(sys.argv[1])).first()
+            if not user:
+                print("No user found.")
+                return
+            user_id = user.id
+        counted = adherence_rollup.rebuild(session, user_id)
+        session.commit()
+        print(f"Rebuilt rollups from {counted} logs.")
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,33 @@
+"""Rebuild achievement streaks from the reminder log history.
+
+Usage: python -m scripts.backfill_streaks [telegram_id]
+
+Streaks are updated as logs are answered; run this after editing logs by hand
+or to repair them. Without an argument every user is rebuilt.
+"""
+import sys
+
+from database import SessionLocal
+from models import User
+from services import streak_service
+
+
+def main() -> None:
+    session = SessionLocal()
+    try:
+        user_id = None
+        if len(sys.argv) > 1:
+            user = session.query(User).filter(User.telegram_id == int(sys.argv[1])).first()
+            if not user:
+                print("No user found.")
+                return
+            user_id = user.id
+        rebuilt = streak_service.rebuild(session, user_id)
+        session.commit()
+        print(f"Rebuilt streaks for {rebuilt} users.")
+    finally:
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
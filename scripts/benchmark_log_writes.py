@@ -0,0 +1,84 @@
+"""Compare per-row commits of reminder answers with buffered bulk writes.
+
+Usage: python -m scripts.benchmark_log_writes [rows] [batch_size] [database_url]
+
+Both runs answer ``rows`` pending logs in a scratch database (a temporary
+SQLite file by default). The per-row run commits each answer on its own as
+``update_log_status`` used to; the buffered run applies them in batches of
+``batch_size`` the way the log buffer does.
+"""
+import datetime as dt
+import os
+import sys
+import tempfile
+import time
+
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+
+from models import Base, User
+from services import reminder_service
+from services.reminder_service import StatusChange
+
+
+def seed(session, rows: int) -> list:
+    user = User(telegram_id=1, name="Benchmark")
+    session.add(user)
+    session.flush()
+    reminder = reminder_service.create_reminder(session, user, {"label": "benchmark", "time_of_day": dt.time(9)})
+    start = dt.datetime.utcnow() - dt.timedelta(days=rows)
+    log_ids = []
+    for day in range(rows):
+        log_ids.append(reminder_service.log_reminder(session, reminder, start + dt.timedelta(days=day)).id)
+    session.commit()
+    return log_ids
+
+
+def per_row(Session, log_ids: list) -> float:
+    started = time.perf_counter()
+    for log_id in log_ids:
+        with Session() as session:
+            log = reminder_service.get_log(session, log_id)
+            reminder_service.update_log_status(session, log, "taken")
+            session.commit()
+    return time.perf_counter() - started
+
+
+def buffered(Session, log_ids: list, batch_size: int) -> float:
+    started = time.perf_counter()
+    now = dt.datetime.utcnow()
+    for offset in range(0, len(log_ids), batch_size):
+        changes = [StatusChange(log_id, "taken", now) for log_id in log_ids[offset:offset + batch_size]]
+        with Session() as session:
+            reminder_service.apply_status_changes(session, changes)
+            session.commit()
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    scratch = None
+    if len(sys.argv) > 3:
+        url = sys.argv[3]
+    else:
+        scratch = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+        url = f"sqlite:///{scratch.name}"
+    engine = sa.create_engine(url)
+    Session = sessionmaker(bind=engine, autoflush=False)
+    try:
+        Base.metadata.create_all(engine)
+        with Session() as session:
+            log_ids = seed(session, rows * 2)
+        row_time = per_row(Session, log_ids[:rows])
+        batch_time = buffered(Session, log_ids[rows:], batch_size)
+        print(f"per-row commits: {rows / row_time:10.0f} answers/s ({row_time:.2f} s)")
+        print(f"buffered x{batch_size}: {rows / batch_time:10.0f} answers/s ({batch_time:.2f} s)")
+    finally:
+        engine.dispose()
+        if scratch is not None:
+            os.unlink(scratch.name)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Print EXPLAIN plans for the queries behind /stats, /achievements and /symptom.
+
+Usage: python -m scripts.explain_hot_queries [telegram_id]
+
+The service functions are run for one user (the first one by default) with
+the statements they send captured; everything they write is rolled back.
+"""
+import sys
+
+import sqlalchemy as sa
+
+from database import SessionLocal, engine
+from models import User
+from services import achievement_service, lifestyle_service, stats_service
+
+
+def capture_queries(session, user: User) -> list:
+    captured = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT") and not executemany:
+            captured.append((statement, parameters))
+
+    sa.event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        stats_service.adherence_summary(session, user)
+        stats_service.weekly_plot(session, user)
+        achievement_service.evaluate_user(session, user)
+        lifestyle_service.symptom_insight(session, user)
+    finally:
+        sa.event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+    unique = {}
+    for statement, parameters in captured:
+        unique.setdefault(statement, parameters)
+    return list(unique.items())
+
+
+def main() -> None:
+    prefix = "EXPLAIN QUERY PLAN " if engine.dialect.name == "sqlite" else "EXPLAIN "
+    session = SessionLocal()
+    try:
+        query = session.query(User)
+        if len(sys.argv) > 1:
+            query = query.filter(User.telegram_id == int(sys.argv[1]))
+        user = query.order_by(User.id).first()
+        if not user:
+            print("No user found.")
+            return
+        queries = capture_queries(session, user)
+        connection = session.connection()
+        for statement, parameters in queries:
+            print(statement.strip())
+            for row in connection.exec_driver_sql(prefix + statement, parameters):
+                print("    " + " | ".join(str(value) for value in row))
+            print()
+    finally:
+        session.rollback()
+        session.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,15 @@
 import datetime as dt
-from typing import List
+from collections import OrderedDict
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Dict, FrozenSet, List, Mapping, Optional, Tuple
 
+from sqlalchemy import ColumnElement, exists, literal, select
 from sqlalchemy.orm import Session
 
-from models import Achievement, ReminderLog, UserAchievement, User
+from models import Achievement, UserAchievement, User, UserStreak
+from services import streak_service
+from services.adherence_rollup import dialect_insert
 
 ACHIEVEMENTS_CATALOG = [
     {
@@ -27,75 +33,126 @@ ACHIEVEMENTS_CATALOG = [
 ]
 
 
-def seed_achievements(session: Session) -> None:
+AWARDED_CACHE_SIZE = 10_000
+# Days with doses taken and none missed or left unanswered, per streak achievement.
+CLEAN_DAYS = {"week_without_miss": 7, "month_champion": 30}
+PLANNER_REMINDERS = 5
+
+
+@dataclass(frozen=True)
+class CatalogEntry:
+    id: int
+    slug: str
+    title: str
+    description: str
+    icon: Optional[str]
+
+
+# Synced once at startup; award checks read ids from here instead of the
+# achievements table.
+_catalog: Optional[Mapping[str, CatalogEntry]] = None
+# Achievement ids awarded per user, least recently used first.
+_awarded: "OrderedDict[int, FrozenSet[int]]" = OrderedDict()
+
+
+def sync_catalog(session: Session) -> Mapping[str, CatalogEntry]:
+    """Insert missing catalog achievements and load the slug map."""
+    global _catalog
+    slugs = [entry["slug"] for entry in ACHIEVEMENTS_CATALOG]
+    rows = {row.slug: row for row in session.query(Achievement).filter(Achievement.slug.in_(slugs))}
     for entry in ACHIEVEMENTS_CATALOG:
-        exists = session.query(Achievement).filter(Achievement.slug == entry["slug"]).first()
-        if not exists:
-            session.add(Achievement(**entry))
-    session.commit()
-
-
-def _has_award(session: Session, user_id: int, slug: str) -> bool:
-    return (
-        session.query(UserAchievement)
-        .join(Achievement)
-        .filter(UserAchievement.user_id == user_id, Achievement.slug == slug)
-        .first()
-        is not None
+        if entry["slug"] not in rows:
+            rows[entry["slug"]] = Achievement(**entry)
+            session.add(rows[entry["slug"]])
+    session.flush()
+    _catalog = MappingProxyType(
+        {
+            slug: CatalogEntry(row.id, row.slug, row.title, row.description, row.icon)
+            for slug, row in rows.items()
+        }
     )
+    return _catalog
 
 
-def evaluate_user(session: Session, user: User) -> List[Achievement]:
-    seed_achievements(session)
-    awarded: List[Achievement] = []
+def catalog(session: Session) -> Mapping[str, CatalogEntry]:
+    return _catalog if _catalog is not None else sync_catalog(session)
 
-    seven_days_ago = dt.datetime.utcnow() - dt.timedelta(days=7)
-    logs_last_week = (
-        session.query(ReminderLog)
-        .filter(
-            ReminderLog.user_id == user.id,
-            ReminderLog.scheduled_for >= seven_days_ago,
-        )
-        .all()
-    )
-    if logs_last_week and all(log.status == "taken" for log in logs_last_week):
-        if not _has_award(session, user.id, "week_without_miss"):
-            achievement = (
-                session.query(Achievement)
-                .filter(Achievement.slug == "week_without_miss")
-                .first()
+
+def awarded_ids(session: Session, user_id: int) -> FrozenSet[int]:
+    awarded = _awarded.get(user_id)
+    if awarded is None:
+        awarded = frozenset(
+            session.scalars(
+                select(UserAchievement.achievement_id).where(UserAchievement.user_id == user_id)
             )
-            session.add(UserAchievement(user_id=user.id, achievement_id=achievement.id))
-            awarded.append(achievement)
-
-    thirty_days_ago = dt.datetime.utcnow() - dt.timedelta(days=30)
-    logs_month = (
-        session.query(ReminderLog)
-        .filter(
-            ReminderLog.user_id == user.id,
-            ReminderLog.scheduled_for >= thirty_days_ago,
         )
-        .all()
+        _awarded[user_id] = awarded
+        if len(_awarded) > AWARDED_CACHE_SIZE:
+            _awarded.popitem(last=False)
+    else:
+        _awarded.move_to_end(user_id)
+    return awarded
+
+
+def invalidate_awards(user_id: int) -> None:
+    _awarded.pop(user_id, None)
+
+
+def evaluate_user(session: Session, user: User) -> List[CatalogEntry]:
+    entries = catalog(session)
+    owned = awarded_ids(session, user.id)
+    streak = streak_service.get_streak(session, user.id)
+    now = dt.datetime.utcnow()
+    unanswered = streak_service.last_unanswered(
+        session, user.id, now - dt.timedelta(days=max(CLEAN_DAYS.values())), now
     )
-    if logs_month and all(log.status == "taken" for log in logs_month):
-        if not _has_award(session, user.id, "month_champion"):
-            achievement = (
-                session.query(Achievement)
-                .filter(Achievement.slug == "month_champion")
-                .first()
-            )
-            session.add(UserAchievement(user_id=user.id, achievement_id=achievement.id))
-            awarded.append(achievement)
-
-    active_reminders = len([r for r in user.reminders if r.active])
-    if active_reminders >= 5 and not _has_award(session, user.id, "master_planner"):
-        achievement = (
-            session.query(Achievement)
-            .filter(Achievement.slug == "master_planner")
-            .first()
+    earned = {slug: streak_service.is_clean(streak, now, days, unanswered) for slug, days in CLEAN_DAYS.items()}
+    earned["master_planner"] = streak.active_reminders >= PLANNER_REMINDERS
+    awarded = [entries[slug] for slug, ok in earned.items() if ok and entries[slug].id not in owned]
+    if awarded:
+        # A concurrent evaluation may have inserted the same award first.
+        session.execute(
+            dialect_insert(session, UserAchievement)
+            .values([{"user_id": user.id, "achievement_id": entry.id} for entry in awarded])
+            .on_conflict_do_nothing(index_elements=["user_id", "achievement_id"])
         )
-        session.add(UserAchievement(user_id=user.id, achievement_id=achievement.id))
-        awarded.append(achievement)
-
-    session.commit()
+        invalidate_awards(user.id)
     return awarded
+
+
+def _rule_conditions(now: dt.datetime) -> Dict[str, ColumnElement]:
+    """The ``evaluate_user`` rules as conditions on ``user_streaks``."""
+    conditions = {slug: streak_service.clean_condition(now, days) for slug, days in CLEAN_DAYS.items()}
+    conditions["master_planner"] = UserStreak.active_reminders >= PLANNER_REMINDERS
+    return conditions
+
+
+def evaluate_all(session: Session, now: Optional[dt.datetime] = None) -> List[Tuple[int, List[CatalogEntry]]]:
+    """Award every catalog achievement to all users who qualify.
+
+    Each rule is one ``INSERT ... SELECT`` over ``user_streaks``. Returns the
+    new awards as ``(telegram_id, entries)`` pairs.
+    """
+    now = now or dt.datetime.utcnow()
+    entries = catalog(session)
+    awarded: Dict[int, List[CatalogEntry]] = {}
+    for slug, condition in _rule_conditions(now).items():
+        entry = entries[slug]
+        already = exists().where(
+            UserAchievement.user_id == UserStreak.user_id, UserAchievement.achievement_id == entry.id
+        )
+        candidates = select(UserStreak.user_id, literal(entry.id), literal(now)).where(condition, ~already)
+        inserted = session.execute(
+            dialect_insert(session, UserAchievement)
+            .from_select(["user_id", "achievement_id", "awarded_at"], candidates)
+            .on_conflict_do_nothing(index_elements=["user_id", "achievement_id"])
+            .returning(UserAchievement.user_id)
+        )
+        for user_id in inserted.scalars():
+            awarded.setdefault(user_id, []).append(entry)
+    for user_id in awarded:
+        invalidate_awards(user_id)
+    if not awarded:
+        return []
+    telegram_ids = dict(session.execute(select(User.id, User.telegram_id).where(User.id.in_(list(awarded)))).all())
+    return [(telegram_ids[user_id], user_entries) for user_id, user_entries in awarded.items()]
@@ -0,0 +1,119 @@
+"""Daily adherence rollups kept in step with reminder log changes.
+
+Every change to a log's status is recorded as deltas on its
+``daily_adherence`` row: the log's user, the reminder's medication and the
+local day of ``scheduled_for`` in the reminder's timezone. Stats read these
+rows instead of the logs. ``rebuild`` recomputes them from the live and
+archived logs.
+"""
+import datetime as dt
+from typing import Dict, Optional, Tuple
+
+import pytz
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from models import DailyAdherence, Reminder, ReminderLog, User
+from services import log_store
+
+COUNT_COLUMNS = ("taken", "missed", "skipped", "snoozed", "pending")
+
+Key = Tuple[int, int, dt.date]
+Deltas = Dict[Key, Dict[str, int]]
+
+
+def status_column(status: Optional[str]) -> str:
+    return status if status in COUNT_COLUMNS else "pending"
+
+
+def local_day(moment: dt.datetime, timezone: Optional[str]) -> dt.date:
+    return pytz.utc.localize(moment).astimezone(pytz.timezone(timezone or "UTC")).date()
+
+
+def user_today(user: User) -> dt.date:
+    return local_day(dt.datetime.utcnow(), user.timezone)
+
+
+def add(
+    deltas: Deltas, reminder: Reminder, scheduled_for: dt.datetime, status: Optional[str], count: int = 1
+) -> None:
+    key = (reminder.user_id, reminder.medication_id or 0, local_day(scheduled_for, reminder.timezone))
+    column = status_column(status)
+    counts = deltas.setdefault(key, {})
+    counts[column] = counts.get(column, 0) + count
+
+
+def move(
+    deltas: Deltas,
+    reminder: Reminder,
+    old: Tuple[dt.datetime, Optional[str]],
+    new: Tuple[dt.datetime, Optional[str]],
+) -> None:
+    """Record a log moving from ``(scheduled_for, status)`` ``old`` to ``new``."""
+    add(deltas, reminder, *old, count=-1)
+    add(deltas, reminder, *new)
+
+
+def dialect_insert(session: Session, model):
+    """``INSERT`` for ``model`` with the dialect's ``on_conflict_*`` support."""
+    if session.get_bind().dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+
+def apply(session: Session, deltas: Deltas) -> None:
+    """Add ``deltas`` to the rollups in one upsert."""
+    rows = []
+    for (user_id, medication_id, day), counts in deltas.items():
+        if not any(counts.values()):
+            continue
+        row = {"user_id": user_id, "medication_id": medication_id, "day": day}
+        row.update({column: counts.get(column, 0) for column in COUNT_COLUMNS})
+        rows.append(row)
+    if not rows:
+        return
+    stmt = dialect_insert(session, DailyAdherence).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["user_id", "medication_id", "day"],
+        set_={column: getattr(DailyAdherence, column) + stmt.excluded[column] for column in COUNT_COLUMNS},
+    )
+    session.execute(stmt)
+
+
+def rebuild(session: Session, user_id: Optional[int] = None, chunk_size: int = 1000) -> int:
+    """Recompute rollups from live and archived logs; returns the logs counted."""
+    delete = sa.delete(DailyAdherence)
+    logs = (
+        session.query(ReminderLog.reminder_id, ReminderLog.scheduled_for, ReminderLog.status)
+        .order_by(ReminderLog.id)
+    )
+    if user_id is not None:
+        delete = delete.where(DailyAdherence.user_id == user_id)
+        logs = logs.filter(ReminderLog.user_id == user_id)
+    session.execute(delete)
+
+    reminders = session.query(Reminder)
+    if user_id is not None:
+        reminders = reminders.filter(Reminder.user_id == user_id)
+    by_id = {reminder.id: reminder for reminder in reminders}
+
+    def archived():
+        for row in log_store.archived_rows(session, user_id):
+            yield row["reminder_id"], dt.datetime.fromisoformat(row["scheduled_for"]), row["status"]
+
+    deltas: Deltas = {}
+    counted = 0
+    for source in (logs.yield_per(chunk_size), archived()):
+        for reminder_id, scheduled_for, status in source:
+            reminder = by_id.get(reminder_id)
+            if reminder is None:
+                continue
+            add(deltas, reminder, scheduled_for, status)
+            counted += 1
+            if len(deltas) >= chunk_size:
+                apply(session, deltas)
+                deltas = {}
+    apply(session, deltas)
+    session.flush()
+    return counted
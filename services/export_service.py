@@ -5,7 +5,8 @@ from typing import Tuple
 
 from sqlalchemy.orm import Session
 
-from models import Medication, ReminderLog, User
+from models import Medication, User
+from services import log_store
 
 
 def _collect_payload(session: Session, user: User) -> dict:
@@ -14,12 +15,7 @@ def _collect_payload(session: Session, user: User) -> dict:
         .filter(Medication.user_id == user.id)
         .all()
     )
-    logs = (
-        session.query(ReminderLog)
-        .filter(ReminderLog.user_id == user.id)
-        .order_by(ReminderLog.scheduled_for.desc())
-        .all()
-    )
+    logs = log_store.export_rows(session, user)
     return {
         "user": {
             "name": user.name,
@@ -38,10 +34,10 @@ def _collect_payload(session: Session, user: User) -> dict:
         ],
         "logs": [
             {
-                "reminder_id": log.reminder_id,
-                "scheduled_for": log.scheduled_for.isoformat(),
-                "status": log.status,
-                "note": log.note,
+                "reminder_id": log["reminder_id"],
+                "scheduled_for": log["scheduled_for"],
+                "status": log["status"],
+                "note": log["note"],
             }
             for log in logs
         ],
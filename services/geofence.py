@@ -0,0 +1,73 @@
+import math
+from typing import Dict, Iterable, List, Set, Tuple
+
+from config import settings
+from models import Reminder
+
+EARTH_RADIUS_M = 6_371_000
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180
+
+Cell = Tuple[int, int]
+Fence = Tuple[int, float, float]
+
+
+def haversine_m(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(1.0, a)))
+
+
+class GeofenceIndex:
+    """Geo reminders bucketed into a lat/lon grid, one grid per user.
+
+    Cells are as tall as the fence radius, so a position only has to be
+    compared with the fences in its own and the neighbouring cells. A fence
+    is reported once when the user enters it and again only after leaving.
+    Users are loaded lazily and dropped with ``invalidate`` when their geo
+    reminders change.
+    """
+
+    def __init__(self, radius_m: float = None):
+        self.radius_m = radius_m or settings.geo_radius_m
+        self.cell_deg = self.radius_m / METERS_PER_DEGREE
+        self._grids: Dict[int, Dict[Cell, List[Fence]]] = {}
+        self._inside: Dict[int, Set[int]] = {}
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._grids
+
+    def load(self, user_id: int, reminders: Iterable[Reminder]) -> None:
+        grid: Dict[Cell, List[Fence]] = {}
+        for reminder in reminders:
+            if reminder.geo_lat is None or reminder.geo_lon is None:
+                continue
+            cell = self._cell(reminder.geo_lat, reminder.geo_lon)
+            grid.setdefault(cell, []).append((reminder.id, reminder.geo_lat, reminder.geo_lon))
+        self._grids[user_id] = grid
+        self._inside.setdefault(user_id, set())
+
+    def invalidate(self, user_id: int) -> None:
+        self._grids.pop(user_id, None)
+
+    def enter(self, user_id: int, lat: float, lon: float) -> List[int]:
+        """Record the user's position and return the fences just entered."""
+        grid = self._grids.get(user_id, {})
+        inside: Set[int] = set()
+        row, col = self._cell(lat, lon)
+        # Longitude degrees shrink towards the poles, so more columns may
+        # fall within the radius there.
+        cos_lat = max(math.cos(math.radians(lat)), 1e-6)
+        span = math.ceil(1 / cos_lat)
+        for d_row in (-1, 0, 1):
+            for d_col in range(-span, span + 1):
+                for reminder_id, fence_lat, fence_lon in grid.get((row + d_row, col + d_col), ()):
+                    if haversine_m(lat, lon, fence_lat, fence_lon) <= self.radius_m:
+                        inside.add(reminder_id)
+        entered = inside - self._inside.get(user_id, set())
+        self._inside[user_id] = inside
+        return sorted(entered)
+
+    def _cell(self, lat: float, lon: float) -> Cell:
+        return math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg)
@@ -1,54 +1,85 @@
 import datetime as dt
-from typing import Optional, Tuple
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Type
 
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 
-from models import MoodLog, SymptomLog, WaterLog, Medication, ReminderLog, User
+from models import MoodLog, SymptomLog, WaterLog, Medication, User
+from services import log_store
 
 
-def log_symptom(
-    session: Session,
+@dataclass(frozen=True)
+class TrackerEntry:
+    """A water, mood or symptom entry waiting in the ingestion buffer."""
+
+    model: Type
+    values: Dict
+
+
+def symptom_entry(
     user: User,
     description: str,
     severity: int,
     medication: Optional[Medication] = None,
-) -> SymptomLog:
-    entry = SymptomLog(
-        user_id=user.id,
-        description=description,
-        severity=severity,
-        related_medication_id=medication.id if medication else None,
+) -> TrackerEntry:
+    return TrackerEntry(
+        SymptomLog,
+        {
+            "user_id": user.id,
+            "description": description,
+            "severity": severity,
+            "related_medication_id": medication.id if medication else None,
+            "logged_at": dt.datetime.utcnow(),
+        },
+    )
+
+
+def mood_entry(user: User, score: int, note: Optional[str] = None) -> TrackerEntry:
+    return TrackerEntry(
+        MoodLog, {"user_id": user.id, "score": score, "note": note, "logged_at": dt.datetime.utcnow()}
     )
-    session.add(entry)
-    session.commit()
-    session.refresh(entry)
-    return entry
 
 
-def symptom_insight(session: Session, user: User) -> Optional[str]:
-    latest = (
-        session.query(SymptomLog)
+def water_entry(user: User, amount_ml: int) -> TrackerEntry:
+    return TrackerEntry(WaterLog, {"user_id": user.id, "amount_ml": amount_ml, "logged_at": dt.datetime.utcnow()})
+
+
+def insert_entries(session: Session, entries: Iterable[TrackerEntry]) -> None:
+    """Write buffered entries with one multi-row INSERT per tracker."""
+    by_model: Dict[Type, List[Dict]] = {}
+    for entry in entries:
+        by_model.setdefault(entry.model, []).append(entry.values)
+    for model, rows in by_model.items():
+        session.execute(insert(model).values(rows))
+    session.flush()
+
+
+def symptom_insight(
+    session: Session, user: User, pending: Iterable[dt.datetime] = ()
+) -> Optional[str]:
+    """``pending`` holds the times of symptoms logged but not written yet."""
+    latest = [
+        logged_at
+        for (logged_at,) in session.query(SymptomLog.logged_at)
         .filter(SymptomLog.user_id == user.id)
         .order_by(SymptomLog.logged_at.desc())
         .limit(5)
-        .all()
-    )
+    ]
+    latest = sorted([*pending, *latest], reverse=True)[:5]
     if not latest:
         return None
 
-    missed = (
-        session.query(ReminderLog)
-        .filter(
-            ReminderLog.user_id == user.id,
-            ReminderLog.status.in_(["missed", "skipped"]),
-            ReminderLog.scheduled_for >= dt.datetime.utcnow() - dt.timedelta(days=7),
-        )
-        .all()
+    missed = log_store.user_logs(
+        session,
+        user,
+        dt.datetime.utcnow() - dt.timedelta(days=7),
+        statuses=["missed", "skipped"],
     )
     if not missed:
         return None
 
-    symptom_days = {entry.logged_at.date() for entry in latest}
+    symptom_days = {logged_at.date() for logged_at in latest}
     missed_days = {log.scheduled_for.date() for log in missed}
     overlap = symptom_days & missed_days
     if overlap:
@@ -57,19 +88,3 @@ def symptom_insight(session: Session, user: User) -> Optional[str]:
             "Пожалуйста, обсудите это с врачом."
         )
     return None
-
-
-def log_mood(session: Session, user: User, score: int, note: Optional[str] = None) -> MoodLog:
-    entry = MoodLog(user_id=user.id, score=score, note=note)
-    session.add(entry)
-    session.commit()
-    session.refresh(entry)
-    return entry
-
-
-def log_water(session: Session, user: User, amount_ml: int) -> WaterLog:
-    entry = WaterLog(user_id=user.id, amount_ml=amount_ml)
-    session.add(entry)
-    session.commit()
-    session.refresh(entry)
-    return entry
@@ -0,0 +1,149 @@
+"""Access to reminder logs across the live table and the cold archive.
+
+On PostgreSQL ``reminder_logs`` is partitioned by month of ``scheduled_for``
+(see migration 3); SQLite keeps a single table. Logs older than
+``LOG_RETENTION_DAYS`` are moved by ``archive_logs`` into
+``reminder_log_archive`` as compressed per-user, per-month batches. Recent
+logs are read from the live table; exports also reach the archive.
+"""
+import datetime as dt
+import json
+import zlib
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from models import ReminderLog, ReminderLogArchive, User
+
+PARTITION_PREFIX = "reminder_logs_"
+ARCHIVE_BATCH_SIZE = 5000
+
+
+def user_logs(
+    session: Session,
+    user: User,
+    since: Optional[dt.datetime] = None,
+    statuses: Optional[Iterable[str]] = None,
+) -> List[ReminderLog]:
+    query = session.query(ReminderLog).filter(ReminderLog.user_id == user.id)
+    if since is not None:
+        query = query.filter(ReminderLog.scheduled_for >= since)
+    if statuses is not None:
+        query = query.filter(ReminderLog.status.in_(list(statuses)))
+    return query.all()
+
+
+def _serialize(log: ReminderLog) -> Dict:
+    return {
+        "id": log.id,
+        "reminder_id": log.reminder_id,
+        "scheduled_for": log.scheduled_for.isoformat(),
+        "status": log.status,
+        "taken_at": log.taken_at.isoformat() if log.taken_at else None,
+        "note": log.note,
+    }
+
+
+def archived_rows(session: Session, user_id: Optional[int] = None) -> Iterator[Dict]:
+    """Archived logs as serialized by ``archive_logs``, batch by batch."""
+    archives = session.query(ReminderLogArchive.payload)
+    if user_id is not None:
+        archives = archives.filter(ReminderLogArchive.user_id == user_id)
+    for (payload,) in archives.yield_per(100):
+        yield from json.loads(zlib.decompress(payload))
+
+
+def export_rows(session: Session, user: User) -> List[Dict]:
+    """All of the user's logs, archived ones included, newest first."""
+    rows = [_serialize(log) for log in user_logs(session, user)]
+    rows.extend(archived_rows(session, user.id))
+    rows.sort(key=lambda row: row["scheduled_for"], reverse=True)
+    return rows
+
+
+def archive_logs(session: Session, cutoff: dt.datetime, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """Move up to ``batch_size`` logs scheduled before ``cutoff`` into the archive."""
+    logs = (
+        session.query(ReminderLog)
+        .filter(ReminderLog.scheduled_for < cutoff)
+        .order_by(ReminderLog.scheduled_for)
+        .limit(batch_size)
+        .all()
+    )
+    if not logs:
+        return 0
+    batches: Dict[Tuple[int, str], List[Dict]] = {}
+    for log in logs:
+        batches.setdefault((log.user_id, f"{log.scheduled_for:%Y-%m}"), []).append(_serialize(log))
+    session.execute(
+        sa.insert(ReminderLogArchive),
+        [
+            {
+                "user_id": user_id,
+                "period": period,
+                "row_count": len(rows),
+                "payload": zlib.compress(json.dumps(rows, ensure_ascii=False).encode("utf-8")),
+                "archived_at": dt.datetime.utcnow(),
+            }
+            for (user_id, period), rows in batches.items()
+        ],
+    )
+    session.execute(
+        sa.delete(ReminderLog)
+        .where(ReminderLog.id.in_([log.id for log in logs]))
+        .execution_options(synchronize_session=False)
+    )
+    session.flush()
+    return len(logs)
+
+
+def month_start(value: dt.datetime) -> dt.date:
+    return dt.date(value.year, value.month, 1)
+
+
+def next_month(month: dt.date) -> dt.date:
+    return dt.date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def partition_ddl(month: dt.date) -> str:
+    return (
+        f"CREATE TABLE IF NOT EXISTS {PARTITION_PREFIX}{month:%Y_%m} PARTITION OF reminder_logs "
+        f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{next_month(month):%Y-%m-%d}')"
+    )
+
+
+def ensure_partitions(session: Session, now: dt.datetime, months_ahead: int = 2) -> None:
+    """Create monthly partitions up to ``months_ahead`` months after ``now``."""
+    if session.get_bind().dialect.name != "postgresql":
+        return
+    month = month_start(now)
+    for _ in range(months_ahead + 1):
+        session.execute(sa.text(partition_ddl(month)))
+        month = next_month(month)
+
+
+def drop_archived_partitions(session: Session, cutoff: dt.datetime) -> List[str]:
+    """Drop monthly partitions that end before ``cutoff`` and have been emptied."""
+    if session.get_bind().dialect.name != "postgresql":
+        return []
+    names = session.scalars(
+        sa.text(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE parent.relname = 'reminder_logs'"
+        )
+    ).all()
+    dropped = []
+    for name in sorted(names):
+        try:
+            month = dt.datetime.strptime(name[len(PARTITION_PREFIX):], "%Y_%m").date()
+        except ValueError:
+            continue
+        if next_month(month) > cutoff.date():
+            continue
+        if session.execute(sa.text(f"SELECT 1 FROM {name} LIMIT 1")).first() is None:
+            session.execute(sa.text(f"DROP TABLE {name}"))
+            dropped.append(name)
+    return dropped
@@ -1,9 +1,13 @@
+import datetime as dt
 from typing import Dict, List, Optional
 
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, func, or_, update
+from sqlalchemy.orm import Session, joinedload
+from sqlalchemy.orm.attributes import set_committed_value
 
 from models import Medication, MedicationRestock, User
 from config import settings
+from services import stock_forecast
 
 
 def _safe_float(value, default: float = 0.0) -> float:
@@ -33,8 +37,7 @@ def create_medication(session: Session, user: User, data: Dict) -> Medication:
         photo_file_id=data.get("photo_file_id"),
     )
     session.add(medication)
-    session.commit()
-    session.refresh(medication)
+    session.flush()
     quantity = data.get("stock_remaining") or data.get("pack_total")
     if quantity:
         session.add(
@@ -44,7 +47,7 @@ def create_medication(session: Session, user: User, data: Dict) -> Medication:
                 note="Initial stock",
             )
         )
-        session.commit()
+        session.flush()
     return medication
 
 
@@ -55,19 +58,68 @@ def list_medications(session: Session, user: User, include_archived: bool = Fals
     return query.order_by(Medication.name.asc()).all()
 
 
+def get_medication(session: Session, med_id: int) -> Optional[Medication]:
+    return (
+        session.query(Medication)
+        .options(joinedload(Medication.user))
+        .filter(Medication.id == med_id)
+        .first()
+    )
+
+
+def _greatest(session: Session, *values):
+    if session.get_bind().dialect.name == "postgresql":
+        return func.greatest(*values)
+    return func.max(*values)
+
+
+def _update_stock(session: Session, medication: Medication, **values) -> float:
+    """Apply ``values`` to the medication row in one UPDATE ... RETURNING.
+
+    The new values are computed by the database, so concurrent updates do not
+    overwrite each other; ``medication`` is refreshed from the returned row.
+    """
+    columns = [getattr(Medication, key) for key in values]
+    row = session.execute(
+        update(Medication)
+        .where(Medication.id == medication.id)
+        .values(**values)
+        .returning(*columns)
+        .execution_options(synchronize_session=False)
+    ).one()
+    # SQLite returns whole REAL values written by RETURNING as integers.
+    for key, value in zip(values, row):
+        set_committed_value(medication, key, float(value))
+    stock_forecast.stock_changed(session, medication)
+    return medication.stock_remaining
+
+
+def adjust_stock(session: Session, medication: Medication, delta: float) -> float:
+    return _update_stock(
+        session, medication, stock_remaining=_greatest(session, Medication.stock_remaining + delta, 0.0)
+    )
+
+
+def set_stock(session: Session, medication: Medication, value: float) -> float:
+    return _update_stock(session, medication, stock_remaining=max(0.0, value))
+
+
 def restock_medication(
     session: Session, medication: Medication, quantity: float, note: Optional[str] = None
 ) -> Medication:
-    medication.stock_remaining += quantity
-    medication.pack_total += quantity
+    _update_stock(
+        session,
+        medication,
+        stock_remaining=Medication.stock_remaining + quantity,
+        pack_total=Medication.pack_total + quantity,
+    )
     restock_entry = MedicationRestock(
         medication_id=medication.id,
         quantity=quantity,
         note=note or "Manual restock",
     )
     session.add(restock_entry)
-    session.commit()
-    session.refresh(medication)
+    session.flush()
     return medication
 
 
@@ -83,18 +135,98 @@ def get_restock_history(session: Session, medication: Medication, limit: int = 1
 
 def toggle_archive(session: Session, medication: Medication, archived: bool) -> Medication:
     medication.archived = archived
-    session.commit()
-    session.refresh(medication)
+    session.flush()
+    stock_forecast.refresh(session, medication)
     return medication
 
 
 def consume_dose(session: Session, medication: Medication, multiplier: float = 1.0) -> Medication:
-    dose = medication.dose_size * multiplier
-    medication.stock_remaining = max(0.0, medication.stock_remaining - dose)
-    session.commit()
-    session.refresh(medication)
+    remaining = Medication.stock_remaining - Medication.dose_size * multiplier
+    _update_stock(session, medication, stock_remaining=_greatest(session, remaining, 0.0))
     return medication
 
 
 def is_low_stock(medication: Medication) -> bool:
-    return medication.stock_remaining <= settings.low_stock_threshold
+    """Low when the forecast runs out within ``low_stock_days``.
+
+    Medications without a forecast (no reminders or nothing taken) fall back
+    to ``low_stock_threshold`` units.
+    """
+    days_left = stock_forecast.days_left(medication)
+    if days_left is None:
+        return medication.stock_remaining <= settings.low_stock_threshold
+    return days_left <= settings.low_stock_days
+
+
+def stock_alert_due(session: Session, medication: Medication) -> bool:
+    """Record whether the medication is low; True when it has just become low.
+
+    Call after changing the stock. The alert is claimed with a conditional
+    UPDATE on ``low_stock_notified``, so concurrent callers send it once.
+    The flag is cleared once the medication is no longer low.
+    """
+    if is_low_stock(medication) and not medication.archived:
+        claimed = session.execute(
+            update(Medication)
+            .where(Medication.id == medication.id, Medication.low_stock_notified.is_(False))
+            .values(low_stock_notified=True)
+            .returning(Medication.id)
+            .execution_options(synchronize_session=False)
+        ).first()
+        set_committed_value(medication, "low_stock_notified", True)
+        return claimed is not None
+    if medication.low_stock_notified and not is_low_stock(medication):
+        session.execute(
+            update(Medication)
+            .where(Medication.id == medication.id)
+            .values(low_stock_notified=False)
+            .execution_options(synchronize_session=False)
+        )
+        set_committed_value(medication, "low_stock_notified", False)
+    return False
+
+
+def claim_low_stock(session: Session) -> List[Medication]:
+    """Reconcile the alert flags with the stock of all medications.
+
+    Flags of medications that are no longer low are cleared; low medications
+    that were never alerted are flagged and returned with their user. The
+    statements use ``ix_medications_runs_out_on`` and, for medications
+    without a forecast, ``ix_medications_low_stock``.
+    """
+    threshold = settings.low_stock_threshold
+    horizon = stock_forecast.today() + dt.timedelta(days=settings.low_stock_days)
+    session.execute(
+        update(Medication)
+        .where(
+            Medication.low_stock_notified.is_(True),
+            or_(
+                Medication.runs_out_on > horizon,
+                and_(Medication.runs_out_on.is_(None), Medication.stock_remaining > threshold),
+            ),
+        )
+        .values(low_stock_notified=False)
+        .execution_options(synchronize_session=False)
+    )
+    claimed = session.scalars(
+        update(Medication)
+        .where(
+            Medication.low_stock_notified.is_(False),
+            Medication.archived.is_(False),
+            or_(
+                Medication.runs_out_on <= horizon,
+                and_(Medication.runs_out_on.is_(None), Medication.stock_remaining <= threshold),
+            ),
+        )
+        .values(low_stock_notified=True)
+        .returning(Medication.id)
+        .execution_options(synchronize_session=False)
+    ).all()
+    if not claimed:
+        return []
+    return (
+        session.query(Medication)
+        .options(joinedload(Medication.user))
+        .filter(Medication.id.in_(claimed))
+        .all()
+    )
@@ -1,79 +1,230 @@
 import datetime as dt
+import heapq
+import itertools
+import logging
+import os
+import socket
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Tuple
 
 import pytz
 from telegram.ext import JobQueue
 
+from config import settings
 from models import Reminder
 
+logger = logging.getLogger(__name__)
+
+WEEKDAY_BITS = {
+    "mon": 1 << 0,
+    "tue": 1 << 1,
+    "wed": 1 << 2,
+    "thu": 1 << 3,
+    "fri": 1 << 4,
+    "sat": 1 << 5,
+    "sun": 1 << 6,
+}
+ALL_DAYS = 0b1111111
+FALLBACK_INTERVAL = dt.timedelta(hours=1)
+# Schedule types that only fire once armed through next_fire_at.
+ARMED_TYPES = ("event", "geo")
+
+
+def parse_days_mask(value: Optional[str]) -> int:
+    if not value:
+        return ALL_DAYS
+    mask = 0
+    for token in value.split(","):
+        mask |= WEEKDAY_BITS.get(token.strip().lower(), 0)
+    return mask or ALL_DAYS
+
+
+def _utcnow() -> dt.datetime:
+    return dt.datetime.now(pytz.UTC)
+
+
+def _aware(value: Optional[dt.datetime]) -> Optional[dt.datetime]:
+    return pytz.UTC.localize(value) if value is not None else None
+
+
+@dataclass(slots=True)
+class ScheduleRecord:
+    """Precompiled schedule of a single reminder kept in the dispatcher heap."""
+
+    reminder_id: int
+    tz: dt.tzinfo
+    time_of_day: Optional[dt.time]
+    days_mask: int
+    interval: Optional[dt.timedelta]
+    anchor: Optional[dt.datetime] = None
+    next_fire: Optional[dt.datetime] = None
+
+    @property
+    def armed(self) -> bool:
+        """Event and geo reminders: they fire only at their armed time."""
+        return self.interval is None and self.time_of_day is None
+
+    @classmethod
+    def compile(cls, reminder: Reminder) -> "ScheduleRecord":
+        tz = pytz.timezone(reminder.timezone or "UTC")
+        anchor = _aware(reminder.last_fired_at or reminder.created_at or dt.datetime.utcnow())
+        if reminder.schedule_type in {"fixed_time", "weekly"} and reminder.time_of_day:
+            days_mask = ALL_DAYS
+            if reminder.schedule_type == "weekly":
+                days_mask = parse_days_mask(reminder.days_of_week)
+            return cls(reminder.id, tz, reminder.time_of_day, days_mask, None)
+        if reminder.schedule_type == "interval" and reminder.interval_hours:
+            interval = dt.timedelta(hours=reminder.interval_hours)
+            return cls(reminder.id, tz, None, ALL_DAYS, interval, anchor)
+        if reminder.schedule_type in ARMED_TYPES:
+            return cls(reminder.id, tz, None, ALL_DAYS, None)
+        # Fallback: hourly
+        return cls(reminder.id, tz, None, ALL_DAYS, FALLBACK_INTERVAL, anchor)
+
+    def following(self, after: dt.datetime) -> Optional[dt.datetime]:
+        if self.interval is not None:
+            # Interval reminders are phased from their creation time, so the
+            # same occurrences come out no matter when the record is compiled.
+            candidate = (self.next_fire or self.anchor) + self.interval
+            if candidate <= after:
+                skipped = (after - candidate) // self.interval + 1
+                candidate += self.interval * skipped
+            return candidate
+        if self.time_of_day is None:
+            # Armed reminders fire once and then wait to be armed again.
+            return None
+
+        local_today = after.astimezone(self.tz).date()
+        for offset in range(8):
+            day = local_today + dt.timedelta(days=offset)
+            if not self.days_mask & (1 << day.weekday()):
+                continue
+            localized = self.tz.localize(dt.datetime.combine(day, self.time_of_day))
+            candidate = localized.astimezone(pytz.UTC)
+            if candidate > after:
+                return candidate
+        raise ValueError(f"Reminder {self.reminder_id} has an empty weekday mask")
+
+
+def next_fire_for(reminder: Reminder, now: Optional[dt.datetime] = None) -> Optional[dt.datetime]:
+    """First fire time of a new reminder as a naive UTC datetime."""
+    next_fire = ScheduleRecord.compile(reminder).following(now or _utcnow())
+    return next_fire.replace(tzinfo=None) if next_fire is not None else None
+
 
 class ReminderScheduler:
+    """Keeps reminders due within the horizon in one heap driven by a single job.
+
+    Occurrences further out are not held in memory; ``refill`` is called
+    periodically with a stream of active reminders and picks them up once they
+    come within the horizon.
+
+    Reminders resume from their persisted ``next_fire_at``. An occurrence
+    missed while the bot was down is fired once if it is at most
+    ``reminder_catchup_window_min`` old and the catch-up policy is ``once``;
+    otherwise it is skipped.
+
+    Several processes may run a scheduler against the same database: every
+    due batch is leased in the database before it is sent (see
+    ``reminder_service.claim_due_reminders``), so each occurrence is
+    delivered by one worker only.
+    """
+
     def __init__(self, job_queue: JobQueue, callback):
         self.job_queue = job_queue
         self.callback = callback
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self.horizon = dt.timedelta(hours=settings.reminder_horizon_hours)
+        self.catchup_policy = settings.reminder_catchup_policy
+        self.catchup_window = dt.timedelta(minutes=settings.reminder_catchup_window_min)
+        self._records: Dict[int, ScheduleRecord] = {}
+        self._heap: List[Tuple[dt.datetime, int, ScheduleRecord]] = []
+        self._sequence = itertools.count()
+        self.job_queue.run_repeating(
+            self._tick,
+            interval=settings.reminder_tick_sec,
+            first=settings.reminder_tick_sec,
+            name="reminder-dispatcher",
+        )
 
-    def job_name(self, reminder_id: int) -> str:
-        return f"reminder::{reminder_id}"
+    def __len__(self) -> int:
+        return len(self._records)
 
     def cancel(self, reminder_id: int) -> None:
-        name = self.job_name(reminder_id)
-        current_jobs = self.job_queue.get_jobs_by_name(name)
-        for job in current_jobs:
-            job.schedule_removal()
+        # Heap entries are dropped lazily once their record is no longer current.
+        self._records.pop(reminder_id, None)
 
     def schedule(self, reminder: Reminder) -> None:
         self.cancel(reminder.id)
         if not reminder.active:
             return
 
-        tz = pytz.timezone(reminder.timezone or "UTC")
-        job_name = self.job_name(reminder.id)
-        data = {"reminder_id": reminder.id}
+        now = _utcnow()
+        record = ScheduleRecord.compile(reminder)
+        record.next_fire = self._resume_point(record, _aware(reminder.next_fire_at), now)
+        if record.next_fire is None or record.next_fire > now + self.horizon:
+            return
+        self._records[reminder.id] = record
+        self._push(record)
 
-        if reminder.schedule_type in {"fixed_time", "weekly"} and reminder.time_of_day:
-            day_map = {
-                "mon": 0,
-                "tue": 1,
-                "wed": 2,
-                "thu": 3,
-                "fri": 4,
-                "sat": 5,
-                "sun": 6,
-            }
-            days = None
-            if reminder.schedule_type == "weekly" and reminder.days_of_week:
-                parsed_days = [
-                    day_map[d.strip().lower()]
-                    for d in reminder.days_of_week.split(",")
-                    if d.strip().lower() in day_map
-                ]
-                if parsed_days:
-                    days = tuple(parsed_days)
-            localized = tz.localize(
-                dt.datetime.combine(dt.date.today(), reminder.time_of_day)
-            )
-            time_utc = localized.astimezone(pytz.UTC).time()
-            kwargs = {
-                "time": time_utc,
-                "data": data,
-                "name": job_name,
-            }
-            if days:
-                kwargs["days"] = days
-            self.job_queue.run_daily(self.callback, **kwargs)
-        elif reminder.schedule_type == "interval" and reminder.interval_hours:
-            self.job_queue.run_repeating(
-                self.callback,
-                interval=reminder.interval_hours * 3600,
-                first=0,
-                data=data,
-                name=job_name,
-            )
-        else:
-            # Fallback: daily at stored time or after 1h
-            self.job_queue.run_repeating(
-                self.callback,
-                interval=3600,
-                first=0,
-                data=data,
-                name=job_name,
-            )
+    def _resume_point(
+        self, record: ScheduleRecord, persisted: Optional[dt.datetime], now: dt.datetime
+    ) -> Optional[dt.datetime]:
+        if persisted is None:
+            return record.following(now)
+        if persisted > now or record.armed:
+            # An armed reminder has no later occurrence to skip to, and its
+            # stale next_fire_at would keep it from being armed again.
+            return persisted
+        if self.catchup_policy == "once" and now - persisted <= self.catchup_window:
+            return persisted
+        record.next_fire = persisted
+        return record.following(now)
+
+    def refill(self, reminders: Iterable[Reminder]) -> int:
+        added = 0
+        for reminder in reminders:
+            if reminder.id in self._records:
+                continue
+            self.schedule(reminder)
+            added += reminder.id in self._records
+        return added
+
+    def _push(self, record: ScheduleRecord) -> None:
+        heapq.heappush(self._heap, (record.next_fire, next(self._sequence), record))
+        if len(self._heap) > 2 * len(self._records) + 64:
+            self._compact()
+
+    def _compact(self) -> None:
+        self._heap = [
+            entry for entry in self._heap
+            if self._records.get(entry[2].reminder_id) is entry[2]
+            and entry[0] == entry[2].next_fire
+        ]
+        heapq.heapify(self._heap)
+
+    def _pop_due(self, now: dt.datetime) -> Dict[dt.datetime, Dict[int, Optional[dt.datetime]]]:
+        """Pop due entries grouped by the minute they were due.
+
+        Each group maps reminder ids to their following fire time, if any.
+        """
+        due: Dict[dt.datetime, Dict[int, Optional[dt.datetime]]] = {}
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, _, record = heapq.heappop(self._heap)
+            if self._records.get(record.reminder_id) is not record or fire_at != record.next_fire:
+                continue
+            minute = fire_at.replace(second=0, microsecond=0)
+            record.next_fire = record.following(now)
+            due.setdefault(minute, {})[record.reminder_id] = record.next_fire
+            if record.next_fire is None or record.next_fire > now + self.horizon:
+                del self._records[record.reminder_id]
+                continue
+            self._push(record)
+        return due
+
+    async def _tick(self, context) -> None:
+        for minute, next_fires in sorted(self._pop_due(_utcnow()).items()):
+            try:
+                await self.callback(context, next_fires, minute)
+            except Exception:
+                logger.exception("Dispatch of %d reminders due at %s failed", len(next_fires), minute)
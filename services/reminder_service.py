@@ -1,9 +1,13 @@
 import datetime as dt
-from typing import Dict, List, Optional, Tuple
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Set
 
-from sqlalchemy.orm import Session
+from sqlalchemy import and_, insert, or_, select, update
+from sqlalchemy.orm import Session, joinedload
 
 from models import Reminder, ReminderLog, User
+from services import adherence_rollup, stock_forecast, streak_service
+from services.reminder_scheduler import ARMED_TYPES, next_fire_for
 
 
 def create_reminder(
@@ -29,47 +33,294 @@ def create_reminder(
         nag_interval_minutes=payload.get("nag_interval_minutes", 15),
         snooze_limit=payload.get("snooze_limit", 3),
     )
+    reminder.next_fire_at = next_fire_for(reminder)
     session.add(reminder)
-    session.commit()
-    session.refresh(reminder)
+    streak_service.reminders_changed(session, user.id, 1)
+    session.flush()
+    stock_forecast.refresh_for_reminder(session, reminder)
     return reminder
 
 
+def _nag_due_at(reminder: Reminder, scheduled_for: dt.datetime) -> Optional[dt.datetime]:
+    if not reminder.nag_enabled:
+        return None
+    return scheduled_for + dt.timedelta(minutes=reminder.nag_interval_minutes or 15)
+
+
 def log_reminder(session: Session, reminder: Reminder, scheduled_for: dt.datetime) -> ReminderLog:
     log = ReminderLog(
         reminder_id=reminder.id,
         user_id=reminder.user_id,
         scheduled_for=scheduled_for,
         status="pending",
+        due_at=_nag_due_at(reminder, scheduled_for),
     )
     session.add(log)
-    session.commit()
-    session.refresh(log)
+    deltas: adherence_rollup.Deltas = {}
+    adherence_rollup.add(deltas, reminder, scheduled_for, log.status)
+    adherence_rollup.apply(session, deltas)
+    session.flush()
     return log
 
 
+def claim_due_reminders(
+    session: Session,
+    reminder_ids: Iterable[int],
+    worker_id: str,
+    now: dt.datetime,
+    lease_seconds: int,
+) -> List[int]:
+    """Lease due reminders to ``worker_id`` so no other worker fires them.
+
+    PostgreSQL claims rows with ``FOR UPDATE SKIP LOCKED``; other backends
+    rely on a conditional UPDATE of the lease columns. Expired leases can be
+    claimed again. Returns the ids leased by this call.
+    """
+    claimable = and_(
+        Reminder.id.in_(list(reminder_ids)),
+        Reminder.active.is_(True),
+        or_(Reminder.next_fire_at.is_(None), Reminder.next_fire_at <= now),
+        or_(Reminder.lease_until.is_(None), Reminder.lease_until < now),
+    )
+    claimed = _claim_rows(
+        session,
+        Reminder,
+        claimable,
+        {
+            "lease_owner": worker_id,
+            "lease_until": now + dt.timedelta(seconds=lease_seconds),
+        },
+    )
+    session.flush()
+    return claimed
+
+
+def _claim_rows(session: Session, model, claimable, values: Dict, limit: Optional[int] = None) -> List[int]:
+    """Apply ``values`` to the rows matching ``claimable`` that no one else holds."""
+    if session.get_bind().dialect.name == "postgresql":
+        query = select(model.id).where(claimable).with_for_update(skip_locked=True)
+        if limit:
+            query = query.order_by(model.id).limit(limit)
+        claimed = session.scalars(query).all()
+        if claimed:
+            session.execute(
+                update(model)
+                .where(model.id.in_(claimed))
+                .values(**values)
+                .execution_options(synchronize_session=False)
+            )
+        return list(claimed)
+    if limit:
+        candidates = select(model.id).where(claimable).order_by(model.id).limit(limit)
+        claimable = and_(model.id.in_(candidates.scalar_subquery()), claimable)
+    return list(
+        session.scalars(
+            update(model)
+            .where(claimable)
+            .values(**values)
+            .returning(model.id)
+            .execution_options(synchronize_session=False)
+        ).all()
+    )
+
+
+def load_due_reminders(session: Session, reminder_ids: Iterable[int]) -> List[Reminder]:
+    return (
+        session.query(Reminder)
+        .options(joinedload(Reminder.user), joinedload(Reminder.medication))
+        .filter(Reminder.id.in_(list(reminder_ids)), Reminder.active.is_(True))
+        .all()
+    )
+
+
+def log_reminders(session: Session, reminders: Iterable[Reminder], scheduled_for: dt.datetime) -> Dict[int, int]:
+    """Insert one pending log per reminder; returns reminder id to log id."""
+    reminders = list(reminders)
+    rows = [
+        {
+            "reminder_id": reminder.id,
+            "user_id": reminder.user_id,
+            "scheduled_for": scheduled_for,
+            "status": "pending",
+            "due_at": _nag_due_at(reminder, scheduled_for),
+        }
+        for reminder in reminders
+    ]
+    if not rows:
+        return {}
+    deltas: adherence_rollup.Deltas = {}
+    for reminder in reminders:
+        adherence_rollup.add(deltas, reminder, scheduled_for, "pending")
+    adherence_rollup.apply(session, deltas)
+    result = session.execute(
+        insert(ReminderLog).returning(ReminderLog.reminder_id, ReminderLog.id),
+        rows,
+    )
+    session.flush()
+    return {reminder_id: log_id for reminder_id, log_id in result}
+
+
+def release_reminders(
+    session: Session,
+    worker_id: str,
+    scheduled_for: dt.datetime,
+    next_fires: Dict[int, Optional[dt.datetime]],
+) -> None:
+    """Advance fired reminders to their following fire time and end the lease.
+
+    Only leases still held by ``worker_id`` are released; a reminder whose
+    lease expired and was claimed by another worker is left to that worker.
+    """
+    session.execute(
+        update(Reminder)
+        .where(Reminder.lease_owner == worker_id)
+        .execution_options(synchronize_session=None),
+        [
+            {
+                "id": reminder_id,
+                "last_fired_at": scheduled_for,
+                "next_fire_at": next_fire,
+                "lease_owner": None,
+                "lease_until": None,
+            }
+            for reminder_id, next_fire in next_fires.items()
+        ],
+    )
+    session.flush()
+
+
 def get_log(session: Session, log_id: int) -> Optional[ReminderLog]:
     return session.query(ReminderLog).filter(ReminderLog.id == log_id).first()
 
 
+def claim_due_logs(session: Session, now: dt.datetime, limit: int = 500) -> List[ReminderLog]:
+    """Take logs with due work: snoozed reminders to deliver and nags to send.
+
+    ``scheduled`` logs are snoozed reminders waiting for delivery; ``pending``
+    logs past ``due_at`` need a nag. The claim clears ``due_at`` so each item
+    is handled once even with several workers sweeping the same table. The
+    rows stay claimed until the caller commits.
+    """
+    claimed = _claim_rows(
+        session,
+        ReminderLog,
+        and_(ReminderLog.due_at <= now, ReminderLog.status.in_(("pending", "scheduled"))),
+        {"due_at": None},
+        limit=limit,
+    )
+    if not claimed:
+        return []
+    return (
+        session.query(ReminderLog)
+        .options(
+            joinedload(ReminderLog.reminder).joinedload(Reminder.medication),
+            joinedload(ReminderLog.user),
+        )
+        .filter(ReminderLog.id.in_(claimed))
+        .all()
+    )
+
+
+def mark_delivered(log: ReminderLog, now: dt.datetime) -> None:
+    # Snoozed deliveries already count as pending in the rollups.
+    log.status = "pending"
+    log.due_at = _nag_due_at(log.reminder, now)
+
+
+def can_snooze(log: ReminderLog, reminder: Reminder) -> bool:
+    return reminder.snooze_limit is None or log.snooze_count < reminder.snooze_limit
+
+
 def update_log_status(
     session: Session, log: ReminderLog, status: str, note: Optional[str] = None
 ) -> ReminderLog:
-    log.status = status
+    deltas: adherence_rollup.Deltas = {}
+    adherence_rollup.move(deltas, log.reminder, (log.scheduled_for, log.status), (log.scheduled_for, status))
+    adherence_rollup.apply(session, deltas)
+    old_status, log.status = log.status, status
     log.taken_at = dt.datetime.utcnow()
+    log.due_at = None
     if note:
         log.note = note
-    session.commit()
-    session.refresh(log)
+    streak_service.record_status(session, log, old_status)
+    session.flush()
     return log
 
 
+@dataclass(frozen=True)
+class StatusChange:
+    """An answer to a reminder log waiting in the write-behind buffer.
+
+    ``snooze_minutes`` is set for snoozes, which also queue a follow-up log.
+    """
+
+    log_id: int
+    status: str
+    at: dt.datetime
+    note: Optional[str] = None
+    snooze_minutes: Optional[int] = None
+
+
+def apply_status_changes(session: Session, changes: Sequence[StatusChange]) -> Set[int]:
+    """Apply buffered answers in order with one bulk UPDATE and INSERT.
+
+    Rollups and streaks are updated as ``update_log_status`` would; a
+    snooze also queues its follow-up log. Returns the ids of users who took
+    a dose.
+    """
+    logs = {
+        log.id: log
+        for log in session.query(ReminderLog)
+        .options(joinedload(ReminderLog.reminder))
+        .filter(ReminderLog.id.in_({change.log_id for change in changes}))
+    }
+    updates: Dict[int, Dict] = {}
+    inserts: List[Dict] = []
+    deltas: adherence_rollup.Deltas = {}
+    took: Set[int] = set()
+    for change in changes:
+        log = logs.get(change.log_id)
+        if log is None:
+            continue
+        row = updates.setdefault(log.id, {"id": log.id, "status": log.status, "note": log.note})
+        old_status = row["status"]
+        adherence_rollup.move(deltas, log.reminder, (log.scheduled_for, old_status), (log.scheduled_for, change.status))
+        streak_service.record(session, log.user_id, log.id, log.scheduled_for, old_status, change.status)
+        row.update(status=change.status, taken_at=change.at, due_at=None)
+        if change.note:
+            row["note"] = change.note
+        if change.status == "taken":
+            took.add(log.user_id)
+        if change.snooze_minutes:
+            new_time = change.at + dt.timedelta(minutes=change.snooze_minutes)
+            adherence_rollup.add(deltas, log.reminder, new_time, "scheduled")
+            inserts.append(
+                {
+                    "reminder_id": log.reminder_id,
+                    "user_id": log.user_id,
+                    "scheduled_for": new_time,
+                    "status": "scheduled",
+                    "due_at": new_time,
+                    "snooze_count": log.snooze_count + 1,
+                }
+            )
+    if updates:
+        session.execute(update(ReminderLog), list(updates.values()))
+    if inserts:
+        session.execute(insert(ReminderLog), inserts)
+    adherence_rollup.apply(session, deltas)
+    session.flush()
+    return took
+
+
 def snooze_log(session: Session, log: ReminderLog, minutes: int) -> ReminderLog:
     new_time = log.scheduled_for + dt.timedelta(minutes=minutes)
+    deltas: adherence_rollup.Deltas = {}
+    adherence_rollup.move(deltas, log.reminder, (log.scheduled_for, log.status), (new_time, "snoozed"))
+    adherence_rollup.apply(session, deltas)
     log.scheduled_for = new_time
     log.status = "snoozed"
-    session.commit()
-    session.refresh(log)
+    session.flush()
     return log
 
 
@@ -82,12 +333,104 @@ def get_user_reminders(session: Session, user: User) -> List[Reminder]:
     )
 
 
-def upcoming_reminders(session: Session) -> List[Reminder]:
-    return session.query(Reminder).filter(Reminder.active.is_(True)).all()
+def get_event_reminders(session: Session, user: User, label: Optional[str] = None) -> List[Reminder]:
+    reminders = (
+        session.query(Reminder)
+        .filter(
+            Reminder.user_id == user.id,
+            Reminder.event_label.isnot(None),
+            Reminder.schedule_type == "event",
+            Reminder.active.is_(True),
+        )
+        .order_by(Reminder.event_label, Reminder.id)
+        .all()
+    )
+    if label:
+        # SQLite's lower() only folds ASCII, so labels are compared here.
+        wanted = label.strip().casefold()
+        reminders = [r for r in reminders if r.event_label.strip().casefold() == wanted]
+    return reminders
+
+
+def arm_event_reminders(
+    session: Session, user: User, label: str, now: Optional[dt.datetime] = None
+) -> List[Reminder]:
+    """Schedule the user's reminders waiting for ``label`` at now + their offset."""
+    now = now or dt.datetime.utcnow()
+    reminders = get_event_reminders(session, user, label)
+    for reminder in reminders:
+        reminder.next_fire_at = now + dt.timedelta(minutes=max(0, reminder.offset_minutes or 0))
+    session.flush()
+    return reminders
+
+
+def get_geo_reminders(session: Session, user: User) -> List[Reminder]:
+    return (
+        session.query(Reminder)
+        .filter(
+            Reminder.user_id == user.id,
+            Reminder.schedule_type == "geo",
+            Reminder.active.is_(True),
+        )
+        .all()
+    )
+
+
+def arm_geo_reminders(
+    session: Session,
+    user: User,
+    reminder_ids: Iterable[int],
+    lat: float,
+    lon: float,
+    cooldown_minutes: int,
+    now: Optional[dt.datetime] = None,
+) -> List[Reminder]:
+    """Store the user's position and arm the entered geo reminders off cooldown."""
+    now = now or dt.datetime.utcnow()
+    user.last_location_lat = lat
+    user.last_location_lon = lon
+    armed = []
+    reminder_ids = list(reminder_ids)
+    if reminder_ids:
+        cooled_down = now - dt.timedelta(minutes=cooldown_minutes)
+        armed = (
+            session.query(Reminder)
+            .filter(
+                Reminder.id.in_(reminder_ids),
+                Reminder.user_id == user.id,
+                Reminder.active.is_(True),
+                Reminder.next_fire_at.is_(None),
+                or_(Reminder.last_fired_at.is_(None), Reminder.last_fired_at <= cooled_down),
+            )
+            .all()
+        )
+        for reminder in armed:
+            reminder.next_fire_at = now
+    session.flush()
+    return armed
+
+
+def upcoming_reminders(
+    session: Session, until: dt.datetime, batch_size: int = 500
+) -> Iterator[Reminder]:
+    return (
+        session.query(Reminder)
+        .filter(
+            Reminder.active.is_(True),
+            or_(
+                and_(Reminder.next_fire_at.is_(None), Reminder.schedule_type.notin_(ARMED_TYPES)),
+                Reminder.next_fire_at <= until,
+            ),
+        )
+        .order_by(Reminder.id)
+        .yield_per(batch_size)
+    )
 
 
 def deactivate_reminder(session: Session, reminder: Reminder) -> Reminder:
+    if reminder.active:
+        streak_service.reminders_changed(session, reminder.user_id, -1)
     reminder.active = False
-    session.commit()
-    session.refresh(reminder)
+    session.flush()
+    stock_forecast.refresh_for_reminder(session, reminder)
     return reminder
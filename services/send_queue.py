@@ -0,0 +1,238 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Dict, List, Optional, Tuple
+
+from telegram import Bot
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    DOSE = 0
+    NAG = 1
+    STOCK = 2
+    NOTICE = 3
+
+
+# Seconds after which a queued message is no longer worth sending.
+DEFAULT_TTL: Dict[Priority, Optional[float]] = {
+    Priority.DOSE: 30 * 60,
+    Priority.NAG: 10 * 60,
+    Priority.STOCK: None,
+    Priority.NOTICE: 5 * 60,
+}
+MAX_ATTEMPTS = 3
+
+
+@dataclass(slots=True)
+class OutgoingMessage:
+    chat_id: int
+    text: str
+    priority: Priority
+    options: dict
+    deadline: Optional[float]
+    collapse_key: Optional[str] = None
+    attempts: int = 0
+    cancelled: bool = False
+    sequence: int = 0
+
+
+class SendQueue:
+    """Single outbound pipe to Telegram.
+
+    Messages are ordered by priority, paced by a token bucket and a
+    minimal interval per chat, retried after ``RetryAfter`` and dropped once
+    their deadline has passed. Queuing a message with the ``collapse_key`` of
+    one still waiting replaces the older message.
+
+    Every process sending with the bot token has its own queue, so the bucket
+    gets ``SEND_RATE_PER_SEC`` divided by ``SEND_PROCESSES``; the processes
+    together stay within the bot's limit.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        rate_per_sec: float = None,
+        chat_interval_sec: float = None,
+    ):
+        self.bot = bot
+        self.rate = rate_per_sec or settings.send_rate_per_sec / max(settings.send_processes, 1)
+        self.chat_interval = (
+            chat_interval_sec if chat_interval_sec is not None else settings.send_chat_interval_sec
+        )
+        self._heap: List[Tuple[int, int, OutgoingMessage]] = []
+        self._sequence = itertools.count()
+        self._by_key: Dict[str, OutgoingMessage] = {}
+        self._chat_ready_at: Dict[int, float] = {}
+        self._tokens = self.rate
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._in_flight: Optional[OutgoingMessage] = None
+
+    def __len__(self) -> int:
+        queued = sum(1 for _, _, message in self._heap if not message.cancelled)
+        return queued + (self._in_flight is not None)
+
+    def submit(
+        self,
+        chat_id: int,
+        text: str,
+        *,
+        priority: Priority = Priority.NOTICE,
+        ttl: Optional[float] = None,
+        collapse_key: Optional[str] = None,
+        **options,
+    ) -> None:
+        ttl = ttl if ttl is not None else DEFAULT_TTL[priority]
+        message = OutgoingMessage(
+            chat_id=chat_id,
+            text=text,
+            priority=priority,
+            options=options,
+            deadline=time.monotonic() + ttl if ttl is not None else None,
+            collapse_key=collapse_key,
+        )
+        if collapse_key:
+            previous = self._by_key.get(collapse_key)
+            if previous is not None:
+                previous.cancelled = True
+            self._by_key[collapse_key] = message
+        self._push(message, next(self._sequence))
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="send-queue")
+
+    async def stop(self, drain_timeout: float = 5.0) -> None:
+        if self._task is None:
+            return
+        deadline = time.monotonic() + drain_timeout
+        while len(self) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if len(self):
+            logger.warning("Send queue stopped with %d undelivered messages", len(self))
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    def _push(self, message: OutgoingMessage, sequence: int) -> None:
+        message.sequence = sequence
+        heapq.heappush(self._heap, (message.priority, sequence, message))
+        self._wakeup.set()
+
+    def _forget(self, message: OutgoingMessage) -> None:
+        if message.collapse_key and self._by_key.get(message.collapse_key) is message:
+            del self._by_key[message.collapse_key]
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                self._in_flight = await self._next_message()
+                await self._take_token()
+                await self._deliver(self._in_flight)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Send queue iteration failed")
+            finally:
+                self._in_flight = None
+
+    async def _next_message(self) -> OutgoingMessage:
+        while True:
+            now = time.monotonic()
+            if self._paused_until > now:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+
+            deferred: List[Tuple[int, int, OutgoingMessage]] = []
+            chosen: Optional[OutgoingMessage] = None
+            while self._heap:
+                entry = heapq.heappop(self._heap)
+                message = entry[2]
+                if message.cancelled:
+                    continue
+                if message.deadline is not None and message.deadline < now:
+                    logger.info(
+                        "Dropping stale %s message for chat %s", message.priority.name, message.chat_id
+                    )
+                    self._forget(message)
+                    continue
+                if self._chat_ready_at.get(message.chat_id, 0.0) > now:
+                    deferred.append(entry)
+                    continue
+                chosen = message
+                break
+            for entry in deferred:
+                heapq.heappush(self._heap, entry)
+            if chosen is not None:
+                self._forget(chosen)
+                return chosen
+
+            timeout = None
+            if deferred:
+                timeout = max(
+                    0.0, min(self._chat_ready_at[entry[2].chat_id] for entry in deferred) - now
+                )
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _take_token(self) -> None:
+        while True:
+            now = time.monotonic()
+            self._tokens = min(self.rate, self._tokens + (now - self._refilled_at) * self.rate)
+            self._refilled_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    async def _deliver(self, message: OutgoingMessage) -> None:
+        now = time.monotonic()
+        self._chat_ready_at[message.chat_id] = now + self.chat_interval
+        if len(self._chat_ready_at) > 10_000:
+            self._chat_ready_at = {
+                chat_id: ready_at for chat_id, ready_at in self._chat_ready_at.items() if ready_at > now
+            }
+        message.attempts += 1
+        try:
+            await self.bot.send_message(chat_id=message.chat_id, text=message.text, **message.options)
+        except RetryAfter as exc:
+            retry_after = float(exc.retry_after)
+            logger.warning("Telegram flood limit hit, pausing sends for %.0fs", retry_after)
+            self._paused_until = time.monotonic() + retry_after
+            self._requeue(message)
+        except BadRequest as exc:
+            logger.warning("Telegram rejected message to %s: %s", message.chat_id, exc)
+        except NetworkError as exc:
+            if message.attempts < MAX_ATTEMPTS:
+                logger.info("Retrying message to %s after network error: %s", message.chat_id, exc)
+                self._requeue(message)
+            else:
+                logger.warning("Giving up on message to %s: %s", message.chat_id, exc)
+        except TelegramError as exc:
+            logger.warning("Failed to send message to %s: %s", message.chat_id, exc)
+
+    def _requeue(self, message: OutgoingMessage) -> None:
+        if message.collapse_key:
+            if message.collapse_key in self._by_key:
+                # A newer message replaced this one while it was in flight.
+                return
+            self._by_key[message.collapse_key] = message
+        self._push(message, message.sequence)
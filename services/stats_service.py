@@ -6,45 +6,46 @@ import matplotlib
 
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
+from sqlalchemy import Integer, cast, func
 from sqlalchemy.orm import Session
 
-from models import Medication, Reminder, ReminderLog, User
+from models import DailyAdherence, Medication, User
+from services import adherence_rollup
+
+
+def _week_start(session: Session, day):
+    """SQL expression for the Monday of ``day``'s ISO week."""
+    if session.get_bind().dialect.name == "postgresql":
+        return func.date_trunc("week", day)
+    weekday = (cast(func.strftime("%w", day), Integer) + 6) % 7
+    return func.date(day, func.printf("-%d days", weekday))
 
 
 def adherence_summary(session: Session, user: User, days: int = 30) -> Dict:
-    since = dt.datetime.utcnow() - dt.timedelta(days=days)
-    logs = (
-        session.query(ReminderLog)
-        .filter(
-            ReminderLog.user_id == user.id,
-            ReminderLog.scheduled_for >= since,
+    since = adherence_rollup.user_today(user) - dt.timedelta(days=days)
+    rows = (
+        session.query(
+            Medication.name,
+            func.sum(DailyAdherence.taken),
+            func.sum(DailyAdherence.missed + DailyAdherence.skipped),
         )
+        .select_from(DailyAdherence)
+        .join(Medication, Medication.id == DailyAdherence.medication_id, isouter=True)
+        .filter(DailyAdherence.user_id == user.id, DailyAdherence.day >= since)
+        .group_by(DailyAdherence.medication_id, Medication.name)
         .all()
     )
-    taken = sum(1 for log in logs if log.status == "taken")
-    missed = sum(1 for log in logs if log.status in {"missed", "skipped"})
+    taken = missed = 0
+    per_med: Dict[str, Dict[str, int]] = {}
+    for name, med_taken, med_missed in rows:
+        taken += med_taken
+        missed += med_missed
+        record = per_med.setdefault(name or "Без привязки", {"taken": 0, "total": 0})
+        record["taken"] += med_taken
+        record["total"] += med_taken + med_missed
     total = taken + missed or 1
     adherence = round((taken / total) * 100, 1)
 
-    per_med: Dict[str, Dict[str, int]] = {}
-    med_logs = (
-        session.query(Medication.name, ReminderLog.status)
-        .join(Reminder, Reminder.id == ReminderLog.reminder_id)
-        .join(Medication, Medication.id == Reminder.medication_id, isouter=True)
-        .filter(
-            ReminderLog.user_id == user.id,
-            ReminderLog.scheduled_for >= since,
-        )
-        .all()
-    )
-    for name, status in med_logs:
-        key = name or "Без привязки"
-        record = per_med.setdefault(key, {"taken": 0, "total": 0})
-        if status in {"taken"}:
-            record["taken"] += 1
-        if status in {"taken", "missed", "skipped"}:
-            record["total"] += 1
-
     return {
         "taken": taken,
         "missed": missed,
@@ -55,26 +56,26 @@ def adherence_summary(session: Session, user: User, days: int = 30) -> Dict:
 
 
 def weekly_plot(session: Session, user: User, weeks: int = 4) -> bytes:
-    since = dt.datetime.utcnow() - dt.timedelta(weeks=weeks)
-    logs = (
-        session.query(ReminderLog)
-        .filter(
-            ReminderLog.user_id == user.id,
-            ReminderLog.scheduled_for >= since,
+    since = adherence_rollup.user_today(user) - dt.timedelta(weeks=weeks)
+    week = _week_start(session, DailyAdherence.day).label("week")
+    rows = (
+        session.query(
+            week,
+            func.sum(DailyAdherence.taken),
+            func.sum(DailyAdherence.taken + DailyAdherence.missed + DailyAdherence.skipped),
         )
+        .filter(DailyAdherence.user_id == user.id, DailyAdherence.day >= since)
+        .group_by(week)
+        .order_by(week)
         .all()
     )
     buckets: Dict[str, Tuple[int, int]] = {}
-    for log in logs:
-        year_week = f"{log.scheduled_for.isocalendar().year}-W{log.scheduled_for.isocalendar().week}"
-        taken, total = buckets.get(year_week, (0, 0))
-        if log.status == "taken":
-            taken += 1
-        if log.status in {"taken", "missed", "skipped"}:
-            total += 1
-        buckets[year_week] = (taken, total)
+    for week_start, taken, total in rows:
+        # PostgreSQL returns a timestamp, SQLite an ISO date string.
+        iso = dt.date.fromisoformat(str(week_start)[:10]).isocalendar()
+        buckets[f"{iso.year}-W{iso.week}"] = (taken, total)
 
-    labels = sorted(buckets.keys())
+    labels = list(buckets)
     adherence = [
         (buckets[label][0] / buckets[label][1] * 100) if buckets[label][1] else 0
         for label in labels
@@ -0,0 +1,192 @@
+"""Forecast of the day each medication runs out.
+
+A medication's ``daily_usage`` is the doses per day planned by its active
+reminders, scaled by the share of its doses actually taken over the last
+``CALIBRATION_DAYS`` (from ``daily_adherence``), times ``dose_size``.
+Medications with only event or geo reminders use the observed taken rate.
+``runs_out_on`` is the UTC day the current stock lasts until at that usage.
+
+Stock changes move ``runs_out_on`` using the stored usage; reminder and
+dose changes recompute the usage with ``refresh``. ``rebuild`` recomputes
+every medication in one vectorized pass and runs nightly to recalibrate.
+"""
+import datetime as dt
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import DailyAdherence, Medication, Reminder
+from services.adherence_rollup import COUNT_COLUMNS
+from services.reminder_scheduler import ARMED_TYPES, FALLBACK_INTERVAL, parse_days_mask
+
+CALIBRATION_DAYS = 28
+SECONDS_PER_DAY = 24 * 3600
+
+
+def today() -> dt.date:
+    return dt.datetime.utcnow().date()
+
+
+def doses_per_day(
+    schedule_type: Optional[str],
+    time_of_day: Optional[dt.time],
+    days_of_week: Optional[str],
+    interval_hours: Optional[int],
+) -> float:
+    """Occurrences per day of a reminder, following ``ScheduleRecord.compile``."""
+    if schedule_type in {"fixed_time", "weekly"} and time_of_day:
+        if schedule_type == "weekly":
+            return bin(parse_days_mask(days_of_week)).count("1") / 7
+        return 1.0
+    if schedule_type == "interval" and interval_hours:
+        return 24 / interval_hours
+    if schedule_type in ARMED_TYPES:
+        return 0.0
+    return SECONDS_PER_DAY / FALLBACK_INTERVAL.total_seconds()
+
+
+def _planned(session: Session, medication_ids: Optional[Iterable[int]] = None) -> Dict[int, float]:
+    query = (
+        sa.select(
+            Reminder.medication_id,
+            Reminder.schedule_type,
+            Reminder.time_of_day,
+            Reminder.days_of_week,
+            Reminder.interval_hours,
+        )
+        .join(Medication, Medication.id == Reminder.medication_id)
+        .where(Reminder.active.is_(True), Medication.archived.is_(False))
+    )
+    if medication_ids is not None:
+        query = query.where(Reminder.medication_id.in_(list(medication_ids)))
+    planned: Dict[int, float] = {}
+    for medication_id, *schedule in session.execute(query):
+        planned[medication_id] = planned.get(medication_id, 0.0) + doses_per_day(*schedule)
+    return planned
+
+
+def _history(
+    session: Session, since: dt.date, medication_ids: Optional[Iterable[int]] = None
+) -> Dict[int, Tuple[int, int]]:
+    """Taken and total logged doses per medication since ``since``."""
+    total = sum(getattr(DailyAdherence, column) for column in COUNT_COLUMNS)
+    query = (
+        sa.select(DailyAdherence.medication_id, sa.func.sum(DailyAdherence.taken), sa.func.sum(total))
+        .where(DailyAdherence.day >= since)
+        .group_by(DailyAdherence.medication_id)
+    )
+    if medication_ids is not None:
+        query = query.where(DailyAdherence.medication_id.in_(list(medication_ids)))
+    return {medication_id: (taken or 0, logged or 0) for medication_id, taken, logged in session.execute(query)}
+
+
+def daily_usage(
+    dose_size: np.ndarray, planned: np.ndarray, taken: np.ndarray, logged: np.ndarray
+) -> np.ndarray:
+    """Units used per day for arrays of medications."""
+    adherence = np.divide(taken, logged, out=np.ones_like(planned), where=logged > 0)
+    doses = np.where(planned > 0, planned * adherence, taken / CALIBRATION_DAYS)
+    return doses * dose_size
+
+
+def runs_out_on(stock: np.ndarray, usage: np.ndarray, start: dt.date) -> list:
+    """Days the stock lasts until; ``None`` where nothing is used."""
+    used = usage > 0
+    days = np.floor(np.divide(np.maximum(stock, 0), usage, out=np.zeros_like(stock), where=used))
+    dates = np.datetime64(start, "D") + days.astype("timedelta64[D]")
+    return [day if day_used else None for day, day_used in zip(dates.astype(dt.date).tolist(), used)]
+
+
+def _forecast(
+    session: Session, medications: Dict[int, Tuple[float, float]], single: bool = False
+) -> Dict[int, Tuple[float, Optional[dt.date]]]:
+    """Usage and run-out day for ``{id: (stock, dose_size)}``."""
+    start = today()
+    ids = list(medications)
+    only = ids if single else None
+    planned = _planned(session, only)
+    history = _history(session, start - dt.timedelta(days=CALIBRATION_DAYS), only)
+    values = np.array(list(medications.values()), dtype=float).reshape(-1, 2)
+    counts = np.array([history.get(id_, (0, 0)) for id_ in ids], dtype=float).reshape(-1, 2)
+    usage = daily_usage(
+        values[:, 1],
+        np.array([planned.get(id_, 0.0) for id_ in ids], dtype=float),
+        counts[:, 0],
+        counts[:, 1],
+    )
+    return dict(zip(ids, zip(usage.tolist(), runs_out_on(values[:, 0], usage, start))))
+
+
+def _store(session: Session, medication: Medication, usage: Optional[float], runs_out: Optional[dt.date]) -> None:
+    session.execute(
+        sa.update(Medication)
+        .where(Medication.id == medication.id)
+        .values(daily_usage=usage, runs_out_on=runs_out)
+        .execution_options(synchronize_session=False)
+    )
+    set_committed_value(medication, "daily_usage", usage)
+    set_committed_value(medication, "runs_out_on", runs_out)
+
+
+def refresh(session: Session, medication: Medication) -> Optional[dt.date]:
+    """Recompute the usage and run-out day of one medication."""
+    if medication.archived:
+        usage, runs_out = None, None
+    else:
+        stock = (medication.stock_remaining or 0.0, medication.dose_size or 0.0)
+        usage, runs_out = _forecast(session, {medication.id: stock}, single=True)[medication.id]
+    _store(session, medication, usage or None, runs_out)
+    return runs_out
+
+
+def stock_changed(session: Session, medication: Medication) -> Optional[dt.date]:
+    """Move the run-out day after a stock change, keeping the usage."""
+    usage = medication.daily_usage
+    if not usage:
+        return medication.runs_out_on
+    (runs_out,) = runs_out_on(np.array([medication.stock_remaining], dtype=float), np.array([usage]), today())
+    _store(session, medication, usage, runs_out)
+    return runs_out
+
+
+def refresh_for_reminder(session: Session, reminder: Reminder) -> None:
+    if reminder.medication_id is not None:
+        medication = session.get(Medication, reminder.medication_id)
+        if medication is not None:
+            refresh(session, medication)
+
+
+def rebuild(session: Session) -> int:
+    """Recompute all medications; returns how many have a run-out day."""
+    session.execute(
+        sa.update(Medication)
+        .where(Medication.archived.is_(True), Medication.daily_usage.is_not(None))
+        .values(daily_usage=None, runs_out_on=None)
+        .execution_options(synchronize_session=False)
+    )
+    rows = session.execute(
+        sa.select(Medication.id, Medication.stock_remaining, Medication.dose_size).where(
+            Medication.archived.is_(False)
+        )
+    ).all()
+    if not rows:
+        return 0
+    forecast = _forecast(session, {id_: (stock or 0.0, dose or 0.0) for id_, stock, dose in rows})
+    session.execute(
+        sa.update(Medication),
+        [
+            {"id": id_, "daily_usage": usage or None, "runs_out_on": runs_out}
+            for id_, (usage, runs_out) in forecast.items()
+        ],
+    )
+    session.flush()
+    return sum(runs_out is not None for _, runs_out in forecast.values())
+
+
+def days_left(medication: Medication, on: Optional[dt.date] = None) -> Optional[int]:
+    if medication.runs_out_on is None:
+        return None
+    return max((medication.runs_out_on - (on or today())).days, 0)
@@ -0,0 +1,160 @@
+"""Per-user streak state so achievement checks do not scan reminder logs.
+
+Answering a log updates the user's ``user_streaks`` row: a taken dose extends
+the streak, a missed or skipped one restarts it. Snoozes are neutral, the
+follow-up log decides. The row also counts the user's active reminders.
+``rebuild`` replays the log history.
+
+A log left unanswered for ``ANSWER_WINDOW_HOURS`` never changes status, so
+it is not in the row; the clean-period checks look such logs up instead.
+"""
+import datetime as dt
+import itertools
+from typing import Dict, List, Optional, Tuple
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from config import settings
+from models import Reminder, ReminderLog, UserStreak
+from services import log_store
+from services.adherence_rollup import dialect_insert
+
+BREAKING = ("missed", "skipped")
+ANSWERED = ("taken",) + BREAKING
+UNANSWERED = ("pending", "scheduled")
+
+
+def get_streak(session: Session, user_id: int) -> UserStreak:
+    streak = session.get(UserStreak, user_id)
+    if streak is None:
+        session.execute(
+            dialect_insert(session, UserStreak)
+            .values(user_id=user_id, current_streak=0, active_reminders=0)
+            .on_conflict_do_nothing(index_elements=["user_id"])
+        )
+        streak = session.get(UserStreak, user_id)
+    return streak
+
+
+def _apply(streak: UserStreak, log_id: int, scheduled_for: dt.datetime, status: str) -> None:
+    if status == "taken":
+        if streak.clean_since is None:
+            streak.clean_since = scheduled_for
+        streak.current_streak += 1
+    elif status in BREAKING:
+        streak.clean_since = max(streak.clean_since or scheduled_for, scheduled_for)
+        streak.current_streak = 0
+    else:
+        return
+    if streak.last_log_at is None or scheduled_for >= streak.last_log_at:
+        streak.last_log_id = log_id
+        streak.last_log_at = scheduled_for
+
+
+def record(
+    session: Session,
+    user_id: int,
+    log_id: int,
+    scheduled_for: dt.datetime,
+    old_status: Optional[str],
+    status: str,
+) -> None:
+    if status == old_status:
+        return
+    _apply(get_streak(session, user_id), log_id, scheduled_for, status)
+
+
+def record_status(session: Session, log: ReminderLog, old_status: Optional[str]) -> None:
+    """Account for ``log`` having changed from ``old_status`` to its status."""
+    record(session, log.user_id, log.id, log.scheduled_for, old_status, log.status)
+
+
+def reminders_changed(session: Session, user_id: int, delta: int) -> None:
+    streak = get_streak(session, user_id)
+    streak.active_reminders = max(0, streak.active_reminders + delta)
+
+
+def answer_deadline(now: dt.datetime) -> dt.datetime:
+    """Logs scheduled before this and still unanswered count as missed."""
+    return now - dt.timedelta(hours=settings.answer_window_hours)
+
+
+def _unanswered(user_id, since: dt.datetime, now: dt.datetime):
+    return sa.and_(
+        ReminderLog.user_id == user_id,
+        ReminderLog.status.in_(UNANSWERED),
+        ReminderLog.scheduled_for >= since,
+        ReminderLog.scheduled_for < answer_deadline(now),
+    )
+
+
+def last_unanswered(session: Session, user_id: int, since: dt.datetime, now: dt.datetime) -> Optional[dt.datetime]:
+    """Latest log scheduled since ``since`` and left unanswered past its window."""
+    return session.scalar(sa.select(sa.func.max(ReminderLog.scheduled_for)).where(_unanswered(user_id, since, now)))
+
+
+def is_clean(streak: UserStreak, now: dt.datetime, days: int, unanswered: Optional[dt.datetime]) -> bool:
+    """Whether the last ``days`` days have a taken dose and no missed one.
+
+    ``unanswered`` is the result of ``last_unanswered`` for a period covering
+    those days.
+    """
+    since = now - dt.timedelta(days=days)
+    return (
+        streak.current_streak > 0
+        and streak.clean_since is not None
+        and streak.clean_since <= since
+        and streak.last_log_at is not None
+        and streak.last_log_at >= since
+        and (unanswered is None or unanswered < since)
+    )
+
+
+def clean_condition(now: dt.datetime, days: int) -> sa.ColumnElement:
+    """``is_clean`` as a condition on ``user_streaks``."""
+    since = now - dt.timedelta(days=days)
+    return sa.and_(
+        UserStreak.current_streak > 0,
+        UserStreak.clean_since <= since,
+        UserStreak.last_log_at >= since,
+        ~sa.exists().where(_unanswered(UserStreak.user_id, since, now)),
+    )
+
+
+def rebuild(session: Session, user_id: Optional[int] = None) -> int:
+    """Recompute streaks from archived, then live logs; returns the users rebuilt."""
+    delete = sa.delete(UserStreak)
+    reminders = session.query(Reminder.user_id, sa.func.count(Reminder.id)).filter(Reminder.active.is_(True))
+    logs = (
+        session.query(ReminderLog.user_id, ReminderLog.id, ReminderLog.scheduled_for, ReminderLog.status)
+        .filter(ReminderLog.status.in_(ANSWERED))
+        .order_by(ReminderLog.scheduled_for)
+    )
+    if user_id is not None:
+        delete = delete.where(UserStreak.user_id == user_id)
+        reminders = reminders.filter(Reminder.user_id == user_id)
+        logs = logs.filter(ReminderLog.user_id == user_id)
+    session.execute(delete)
+
+    # Archived logs all predate the live ones.
+    owners = dict(session.query(Reminder.id, Reminder.user_id))
+    archived: List[Tuple[int, int, dt.datetime, str]] = [
+        (owners[row["reminder_id"]], row["id"], dt.datetime.fromisoformat(row["scheduled_for"]), row["status"])
+        for row in log_store.archived_rows(session, user_id)
+        if row["status"] in ANSWERED and row["reminder_id"] in owners
+    ]
+    archived.sort(key=lambda entry: entry[2])
+
+    streaks: Dict[int, UserStreak] = {
+        owner: UserStreak(user_id=owner, current_streak=0, active_reminders=count)
+        for owner, count in reminders.group_by(Reminder.user_id)
+    }
+    for owner, log_id, scheduled_for, status in itertools.chain(archived, logs.yield_per(1000)):
+        streak = streaks.get(owner)
+        if streak is None:
+            streak = streaks[owner] = UserStreak(user_id=owner, current_streak=0, active_reminders=0)
+        _apply(streak, log_id, scheduled_for, status)
+    session.add_all(streaks.values())
+    session.flush()
+    return len(streaks)
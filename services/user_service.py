@@ -1,21 +1,80 @@
-﻿from typing import Optional
+﻿import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
 
-from sqlalchemy.orm import Session
+from sqlalchemy import event
+from sqlalchemy.orm import Session, make_transient_to_detached
+from sqlalchemy.orm.util import identity_key
 
+from config import settings
 from models import User
 from utils.personality import DEFAULT_PERSONALITY
 
+USER_CACHE_SIZE = 10_000
+
+# telegram_id -> (expiry, column values) of users recently seen by ensure_user.
+# Entries are dropped when the user is updated through this process; changes
+# made by another process (the WebApp, a worker) are picked up once the entry
+# expires, at most USER_CACHE_TTL_SEC later.
+_cache: "OrderedDict[int, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+_COLUMNS = [attr.key for attr in User.__mapper__.column_attrs]
+
+
+def invalidate_user(telegram_id: int) -> None:
+    _cache.pop(telegram_id, None)
+
+
+@event.listens_for(User, "after_update")
+def _user_updated(mapper, connection, target: User) -> None:
+    invalidate_user(target.telegram_id)
+
+
+def _remember(user: User) -> None:
+    _cache[user.telegram_id] = (
+        time.monotonic() + settings.user_cache_ttl_sec,
+        {key: getattr(user, key) for key in _COLUMNS},
+    )
+    _cache.move_to_end(user.telegram_id)
+    if len(_cache) > USER_CACHE_SIZE:
+        _cache.popitem(last=False)
+
+
+def _cached_user(session: Session, telegram_id: int) -> Optional[User]:
+    """The cached user attached to ``session`` without a query, if fresh."""
+    entry = _cache.get(telegram_id)
+    if entry is None:
+        return None
+    expires, values = entry
+    if expires < time.monotonic():
+        invalidate_user(telegram_id)
+        return None
+    _cache.move_to_end(telegram_id)
+    loaded = session.identity_map.get(identity_key(User, values["id"]))
+    if loaded is not None:
+        return loaded
+    user = User(**values)
+    make_transient_to_detached(user)
+    return session.merge(user, load=False)
+
 
 def get_user(session: Session, telegram_id: int) -> Optional[User]:
     return session.query(User).filter(User.telegram_id == telegram_id).first()
 
 
 def ensure_user(session: Session, telegram_user) -> User:
-    user = get_user(session, telegram_user.id)
+    """Load or create the user; writes only when the Telegram profile changed."""
+    user = _cached_user(session, telegram_user.id)
+    cached = user is not None
+    if not cached:
+        user = get_user(session, telegram_user.id)
     if user:
-        user.username = telegram_user.username
-        user.name = telegram_user.full_name or telegram_user.first_name or user.name
-        session.commit()
+        name = telegram_user.full_name or telegram_user.first_name or user.name
+        if user.username != telegram_user.username or user.name != name:
+            user.username = telegram_user.username
+            user.name = name
+            session.flush()
+        elif not cached:
+            _remember(user)
         return user
 
     user = User(
@@ -26,8 +85,7 @@ def ensure_user(session: Session, telegram_user) -> User:
         bot_personality=DEFAULT_PERSONALITY,
     )
     session.add(user)
-    session.commit()
-    session.refresh(user)
+    session.flush()
     return user
 
 
@@ -60,7 +118,7 @@ def update_profile(
         user.weight = weight
     if profile_update_notifications is not None:
         user.profile_update_notifications = profile_update_notifications
-    session.commit()
-    session.refresh(user)
+    session.flush()
+    invalidate_user(user.telegram_id)
     return user
 
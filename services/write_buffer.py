@@ -0,0 +1,109 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Generic, List, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+MAX_ATTEMPTS = 3
+
+
+class WriteBuffer(Generic[T]):
+    """Write-behind buffer handing items to ``flush`` in batches.
+
+    A batch goes out every ``interval`` seconds, or as soon as ``max_items``
+    are waiting. With ``max_pending`` set, ``put`` waits while that many
+    items are buffered, so producers slow down to the pace of the database.
+    A failing batch is put back and retried up to ``MAX_ATTEMPTS`` times.
+    ``stop`` flushes whatever is left.
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[List[T]], Awaitable[None]],
+        *,
+        interval: float,
+        max_items: int,
+        max_pending: Optional[int] = None,
+        name: str = "write-buffer",
+    ):
+        self._flush_batch = flush
+        self.interval = interval
+        self.max_items = max_items
+        self.max_pending = max_pending
+        self.name = name
+        self._items: List[T] = []
+        self._in_flight: List[T] = []
+        self._attempts = 0
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Condition()
+        self._lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self._items) + len(self._in_flight)
+
+    def pending(self) -> List[T]:
+        """Items not yet committed, oldest first, including a batch being flushed."""
+        return self._in_flight + self._items
+
+    async def put(self, item: T) -> None:
+        if self.max_pending is not None and len(self._items) >= self.max_pending:
+            self._wakeup.set()
+            async with self._space:
+                await self._space.wait_for(lambda: len(self._items) < self.max_pending)
+        self._items.append(item)
+        if len(self._items) >= self.max_items:
+            self._wakeup.set()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name=self.name)
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            # Holding the lock makes sure the task is not cancelled mid-flush.
+            async with self._lock:
+                self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+        if self._items:
+            logger.error("%s stopped with %d unwritten items", self.name, len(self._items))
+
+    async def flush(self) -> int:
+        """Write everything buffered so far; returns the number of items written."""
+        async with self._lock:
+            if not self._items:
+                return 0
+            self._in_flight, self._items = self._items, []
+            try:
+                await self._flush_batch(self._in_flight)
+            except Exception:
+                self._attempts += 1
+                if self._attempts >= MAX_ATTEMPTS:
+                    logger.exception("%s dropped %d items", self.name, len(self._in_flight))
+                    self._attempts = 0
+                else:
+                    logger.exception("%s flush failed, will retry", self.name)
+                    self._items[:0] = self._in_flight
+                return 0
+            finally:
+                written, self._in_flight = self._in_flight, []
+                async with self._space:
+                    self._space.notify_all()
+            self._attempts = 0
+            return len(written)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            await self.flush()
@@ -0,0 +1,102 @@
+import asyncio
+import datetime as dt
+import itertools
+from types import SimpleNamespace
+
+import pytest
+
+from database import SessionLocal, init_db
+from handlers import reminders
+from models import Medication, ReminderLog, User
+from services import reminder_service
+from services.write_buffer import WriteBuffer
+
+_telegram_ids = itertools.count(2000)
+
+
+class FakeQuery:
+    def __init__(self, data: str, user_id: int):
+        self.data = data
+        self.from_user = SimpleNamespace(id=user_id)
+        self.texts = []
+
+    async def answer(self):
+        pass
+
+    async def edit_message_text(self, text, **kwargs):
+        self.texts.append(text)
+
+
+class FakeSendQueue:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, *args, **kwargs):
+        self.submitted.append(args)
+
+
+@pytest.fixture
+def dose():
+    """A pending log for a daily reminder of a medication with 10 units left."""
+    init_db()
+    session = SessionLocal()
+    user = User(telegram_id=next(_telegram_ids), name="Test")
+    session.add(user)
+    session.flush()
+    medication = Medication(user_id=user.id, name="Aspirin", stock_remaining=10, dose_size=1, pack_total=10)
+    session.add(medication)
+    session.flush()
+    reminder = reminder_service.create_reminder(
+        session, user, {"label": "a", "time_of_day": dt.time(9)}, medication_id=medication.id
+    )
+    log = reminder_service.log_reminder(session, reminder, dt.datetime.utcnow())
+    session.commit()
+    ids = SimpleNamespace(user=user.telegram_id, medication=medication.id, log=log.id)
+    session.close()
+    return ids
+
+
+async def tap(context, data: str, user_id: int) -> list:
+    query = FakeQuery(data, user_id)
+    update = SimpleNamespace(callback_query=query)
+    if data.startswith("rem_snooze"):
+        await reminders.reminder_snooze(update, context)
+    else:
+        await reminders.reminder_action(update, context)
+    return query.texts
+
+
+@pytest.mark.parametrize(
+    "first, later",
+    [("take", "snooze"), ("skip", "snooze"), ("take", "take")],
+)
+@pytest.mark.parametrize("flushed", [False, True])
+def test_tap_after_answer_changes_nothing(dose, first, later, flushed):
+    async def scenario():
+        buffer = WriteBuffer(reminders.flush_log_changes, interval=3600, max_items=100)
+        send_queue = FakeSendQueue()
+        context = SimpleNamespace(
+            application=SimpleNamespace(bot_data={"log_buffer": buffer, "send_queue": send_queue})
+        )
+        first_texts = await tap(context, f"rem_action:{first}:{dose.log}", dose.user)
+        if flushed:
+            await buffer.flush()
+        queued = len(buffer)
+        data = f"rem_snooze:{dose.log}:10" if later == "snooze" else f"rem_action:{later}:{dose.log}"
+        later_texts = await tap(context, data, dose.user)
+        assert later_texts == first_texts
+        assert len(buffer) == queued
+        assert send_queue.submitted == []
+        await buffer.flush()
+
+    asyncio.run(scenario())
+
+    session = SessionLocal()
+    try:
+        log = session.get(ReminderLog, dose.log)
+        assert log.status == reminders.ACTION_STATUSES[first]
+        assert log.snooze_count == 0
+        expected_stock = 9 if first == "take" else 10
+        assert session.get(Medication, dose.medication).stock_remaining == expected_stock
+    finally:
+        session.close()
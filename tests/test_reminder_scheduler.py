@@ -0,0 +1,53 @@
+import datetime as dt
+
+import pytest
+import pytz
+
+from models import Reminder
+from services.reminder_scheduler import ReminderScheduler
+
+
+class FakeJobQueue:
+    def run_repeating(self, *args, **kwargs):
+        pass
+
+
+def make_scheduler(policy: str) -> ReminderScheduler:
+    scheduler = ReminderScheduler(FakeJobQueue(), callback=None)
+    scheduler.catchup_policy = policy
+    return scheduler
+
+
+@pytest.mark.parametrize("policy", ["once", "skip"])
+@pytest.mark.parametrize("schedule_type", ["event", "geo"])
+def test_armed_reminder_fires_once_after_downtime(policy, schedule_type):
+    armed_at = dt.datetime.utcnow() - dt.timedelta(hours=2)
+    reminder = Reminder(id=1, schedule_type=schedule_type, timezone="UTC", active=True, next_fire_at=armed_at)
+    scheduler = make_scheduler(policy)
+
+    scheduler.schedule(reminder)
+
+    assert len(scheduler) == 1
+    due = scheduler._pop_due(dt.datetime.now(pytz.UTC))
+    assert list(due.values()) == [{1: None}]
+    assert len(scheduler) == 0
+
+
+def test_skip_policy_moves_periodic_reminder_past_downtime():
+    missed = dt.datetime.utcnow() - dt.timedelta(hours=2)
+    reminder = Reminder(
+        id=2,
+        schedule_type="interval",
+        interval_hours=1,
+        timezone="UTC",
+        active=True,
+        created_at=missed,
+        next_fire_at=missed,
+    )
+    scheduler = make_scheduler("skip")
+    now = dt.datetime.now(pytz.UTC)
+
+    scheduler.schedule(reminder)
+
+    assert scheduler._pop_due(now) == {}
+    assert len(scheduler) == 1
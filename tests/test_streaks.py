@@ -0,0 +1,57 @@
+import datetime as dt
+import itertools
+
+import pytest
+
+from database import SessionLocal, init_db
+from models import User
+from services import achievement_service, reminder_service
+
+_telegram_ids = itertools.count(1000)
+
+
+@pytest.fixture
+def session():
+    init_db()
+    session = SessionLocal()
+    achievement_service.sync_catalog(session)
+    try:
+        yield session
+    finally:
+        session.rollback()
+        session.close()
+
+
+def daily_logs(session, days: int, answer):
+    """A user with one daily log for each of the last ``days`` days, oldest first."""
+    user = User(telegram_id=next(_telegram_ids), name="Test")
+    session.add(user)
+    session.flush()
+    reminder = reminder_service.create_reminder(session, user, {"label": "a", "time_of_day": dt.time(9)})
+    now = dt.datetime.utcnow()
+    for age in range(days, 0, -1):
+        log = reminder_service.log_reminder(session, reminder, now - dt.timedelta(days=age))
+        status = answer(age)
+        if status:
+            reminder_service.update_log_status(session, log, status)
+    return user
+
+
+def awarded_slugs(session, user):
+    return {entry.slug for entry in achievement_service.evaluate_user(session, user)}
+
+
+def test_week_of_taken_doses_earns_award(session):
+    user = daily_logs(session, 8, lambda age: "taken")
+    assert "week_without_miss" in awarded_slugs(session, user)
+
+
+def test_unanswered_doses_break_the_week(session):
+    user = daily_logs(session, 8, lambda age: "taken" if age == 8 else None)
+    assert "week_without_miss" not in awarded_slugs(session, user)
+    assert achievement_service.evaluate_all(session) == []
+
+
+def test_missed_dose_breaks_the_week(session):
+    user = daily_logs(session, 8, lambda age: "missed" if age == 3 else "taken")
+    assert "week_without_miss" not in awarded_slugs(session, user)